@@ -1,12 +1,158 @@
 """This file contains the basis analysis class for the ALiBaVa analysis"""
 #pylint: disable=C0103
 import logging
-from time import time
-import gc
 import numpy as np
-from tqdm import tqdm
-import matplotlib.pyplot as plt
-from analysis_classes.nb_analysis import parallel_event_processing
+from analysis_classes.event_store import EventStore
+from analysis_classes.histogram import Histogram
+
+def np_process_all_events(events, pedestal, meanCMN, meanCMsig, noise, noisy_strips):
+    """Common mode correction of all events at once (numpy only).
+    Per event, the common mode is the mean of all channels with a signal lower than
+    5*CMsig+CMN, noisy strips are set to 0 before.
+
+    :return: corrected signal, SN (both events x channels), common mode and its std per event
+    """
+    signal = np.subtract(events, pedestal, dtype=np.float32)  # Get the signal from event and subtract pedestal
+    signal[:, noisy_strips] = 0
+
+    # Remove channels which have a signal higher then 5*CMsig+CMN which are not representative
+    mask = signal < (5 * meanCMsig + meanCMN)
+    count = np.maximum(np.count_nonzero(mask, axis=1), 1)
+    CMN = np.sum(np.where(mask, signal, 0), axis=1, dtype=np.float64) / count
+    CMsig = np.sqrt(np.sum(np.where(mask, signal - CMN[:, None], 0) ** 2, axis=1, dtype=np.float64) / count)
+
+    signal -= CMN[:, None].astype(np.float32)
+    SN = signal / noise
+    # A default value if everything fails
+    empty = ~mask.any(axis=1)
+    signal[empty] = 0
+    SN[empty] = 0
+    CMN[empty] = 0
+    CMsig[empty] = 0
+    return signal, SN.astype(np.float32), CMN.astype(np.float32), CMsig.astype(np.float32)
+
+
+def np_cluster_all_events(signal, SN, noise, SN_cut, SN_ratio, SN_cluster, max_clustersize=5,
+                          masking=True, material=1):
+    """Clusters all events at once (numpy only), with the same rules and output as
+    nb_analysis.cluster_all_events.
+
+    Clusters are contiguous strips above SN_cut*SN_ratio (SN_ratio <= 1) with the right
+    polarity. These runs are labelled over the flattened events, a cluster grows from the
+    leftmost unused seed at most int(max_clustersize/2) strips to each side. All runs are
+    handled at once, the loop only goes over the number of clusters within one run.
+    """
+    numevents, numchan = SN.shape
+    width = numchan + 1  # A padding strip ends the runs at the event borders
+    offset = int(max_clustersize * 0.5)
+    absSN = np.abs(SN)
+    hits = absSN > SN_cut
+    if masking:
+        valid = signal < 0 if material else signal > 0
+        automasked = int(np.count_nonzero(hits & (signal > 0 if material else signal < 0)))
+    else:
+        valid = np.ones(SN.shape, dtype=bool)
+        automasked = 0
+
+    hit_offsets = np.zeros(numevents + 1, dtype=np.int64)
+    hit_offsets[1:] = np.cumsum(np.count_nonzero(hits, axis=1))
+    hit_channels = np.nonzero(hits)[1].astype(np.int32)
+
+    # Run length labelling of the strips which can be part of a cluster
+    strips = np.zeros((numevents, width), dtype=bool)
+    strips[:, :numchan] = valid & ((absSN > SN_cut * SN_ratio) | hits)
+    strips = strips.ravel()
+    previous = np.concatenate(([False], strips[:-1]))
+    following = np.concatenate((strips[1:], [False]))
+    run_start = np.flatnonzero(strips & ~previous)
+    run_end = np.flatnonzero(strips & ~following)
+    run_id = np.cumsum(strips & ~previous) - 1
+
+    seeds = np.zeros((numevents, width), dtype=bool)
+    seeds[:, :numchan] = hits & valid
+    seed_pos = np.flatnonzero(seeds)
+    seed_run = run_id[seed_pos]
+    seed_ch = seed_pos % width
+    reach = np.clip(np.minimum(np.minimum(seed_ch - 1, numchan - 1 - seed_ch), offset), 0, None)
+
+    lowest = run_start.copy()  # Lowest unused strip of every run
+    left, right = [], []
+    pending = np.arange(len(seed_pos))
+    while len(pending):
+        # The first pending seed of every run starts a cluster
+        first = np.ones(len(pending), dtype=bool)
+        first[1:] = seed_run[pending[1:]] != seed_run[pending[:-1]]
+        current = pending[first]
+        run = seed_run[current]
+        left.append(np.maximum(lowest[run], seed_pos[current] - reach[current]))
+        right.append(np.minimum(run_end[run], seed_pos[current] + reach[current]))
+        lowest[run] = right[-1] + 1
+        # Seeds inside of the new clusters are used
+        pending = pending[~first]
+        pending = pending[seed_pos[pending] >= lowest[seed_run[pending]]]
+
+    left = np.concatenate(left) if left else np.zeros(0, dtype=np.int64)
+    right = np.concatenate(right) if right else np.zeros(0, dtype=np.int64)
+    order = np.argsort(left, kind="stable")
+    left, right = left[order], right[order]
+
+    # Look if the cluster SN is big enough to be counted as clusters
+    flat_signal = np.zeros((numevents, width), dtype=np.float64)
+    flat_signal[:, :numchan] = signal
+    signal_sum = np.concatenate(([0.], np.cumsum(flat_signal.ravel())))
+    noise_sum = np.concatenate(([0.], np.cumsum(noise, dtype=np.float64)))
+    Scluster = np.abs(signal_sum[right + 1] - signal_sum[left])
+    Ncluster = np.sqrt(np.abs(noise_sum[right % width + 1] - noise_sum[left % width]))
+    SNcluster = Scluster / Ncluster
+    good = SNcluster > SN_cluster
+
+    return (hit_channels, hit_offsets, (left[good] // width).astype(np.int64),
+            (left[good] % width).astype(np.int32), (right[good] - left[good] + 1).astype(np.int32),
+            Scluster[good].astype(np.float32), SNcluster[good].astype(np.float32), automasked)
+
+
+class EventAccumulator:
+    """Folds the processed data of event chunks into histograms of the run (hitmap,
+    number of clusters and clustersizes). Only the events which should be
+    plotted and the signal of the two strip clusters (charge sharing) are kept,
+    so the memory needed does not grow with the signal of every event."""
+
+    def __init__(self, numchan, keep_events=()):
+        """
+        :param numchan: number of channels
+        :param keep_events: event numbers whose signal and SN should be kept
+        """
+        self.numevents = 0
+        self.hitmap = Histogram.integer(0, numchan)
+        self.numclus = Histogram.integer(0, numchan + 1)
+        self.clustersize = Histogram.integer(0, numchan + 1)
+        self.keep_events = set(keep_events)
+        self.events = {"Signal": {}, "SN": {}}
+        self.amplitudes = []
+
+    def __getitem__(self, label):
+        return self.events[label]
+
+    def add(self, store):
+        """Adds the EventStore of the next chunk"""
+        self.hitmap.add(store.hit_channels)
+        self.numclus.add(store.numclus)
+        self.clustersize.add(store.cluster_size)
+        if store.signal is not None:
+            self.amplitudes.append(store.two_strip_amplitudes())
+        for event in self.keep_events:
+            if self.numevents <= event < self.numevents + store.numevents:
+                self.events["Signal"][event] = store.signal[event - self.numevents].copy()
+                self.events["SN"][event] = store.SN[event - self.numevents].copy()
+        self.numevents += store.numevents
+
+    def two_strip_amplitudes(self, numclus=1):
+        """Signal of the left and right strip of the clusters of size two, like
+        EventStore.two_strip_amplitudes (only events with one cluster are kept)"""
+        if numclus != 1:
+            raise KeyError("Only the two strip clusters of events with one cluster are kept")
+        return np.concatenate(self.amplitudes) if self.amplitudes else np.zeros((0, 2), dtype=np.float32)
+
 
 class BaseAnalysis:
 
@@ -24,39 +170,19 @@ class BaseAnalysis:
         self.main.numgoodevents += int(gtime[0].shape[0])
         meanCMN = np.mean(self.main.CMN)
         meanCMsig = np.mean(self.main.CMsig)
-        prodata = []  # List of processed data which then can be accessed
-        hitmap = np.zeros(self.main.numchan)
         # Warning: If you have a RS and pulseshape recognition enabled the
         # timing window has to be set accordingly
 
         if not self.main.usejit:
-            # Non jitted version
-            iter = 0
-            for event in tqdm(range(gtime[0].shape[0]), desc="Events processed:"):  # Loop over all good events
-                # Event and Cluster Calculations
-                iter += 1
-                if iter == 1000:
-                    gc.collect()
-                    iter = 0
-                signal, SN, CMN, CMsig = self.process_event(self.events[event], self.main.pedestal, meanCMN, meanCMsig,
-                                                            self.main.noise, self.main.numchan)
-                channels_hit, clusters, numclus, clustersize = self.clustering(signal, SN, self.main.noise)
-                for channel in channels_hit:
-                    hitmap[int(channel)] += 1
-
-                prodata.append([
-                    signal,
-                    SN,
-                    CMN,
-                    CMsig,
-                    hitmap,
-                    channels_hit,
-                    clusters,
-                    numclus,
-                    clustersize]
-                )
+            # Non jitted version, all events are processed at once with numpy
+            signal, SN, CMN, CMsig = np_process_all_events(self.events[gtime[0]], self.main.pedestal, meanCMN,
+                                                           meanCMsig, self.main.noise,
+                                                           self.main.noisy_strips)
+            prodata = self.cluster(signal, SN, CMN, CMsig)
 
         else:
+            # Numba is only imported for the jitted version
+            from analysis_classes.nb_analysis import parallel_event_processing
             # This should, in theory, use parallelization of the loop over event
             # but i did not see any performance boost, maybe you can find the bug =)?
             data, automasked_hits = parallel_event_processing(gtime,
@@ -74,131 +200,60 @@ class BaseAnalysis:
                                                               material=self.main.material,
                                                               poolsize=self.main.process_pool,
                                                               Pool=self.main.Pool,
-                                                              noisy_strips=self.main.noise_analysis.noisy_strips)
+                                                              noisy_strips=self.main.noisy_strips,
+                                                              parallel=self.main.parallel_clustering)
             prodata = data
-            self.main.automasked_hit = automasked_hits
+            self.main.automasked_hit += automasked_hits
 
         return prodata
 
-    def clustering(self, event, SN, Noise):
-        """Looks for cluster in a event"""
-        # Only channels which have a signal/Noise higher then the signal/Noise cut
-        channels = np.nonzero(np.abs(SN) > self.main.SN_cut)[0]
-        valid_ind = np.arange(len(event))
-
-        if self.main.masking:
-            if self.main.material:
-                # So only negative values are considered
-                masked_ind = np.nonzero(np.take(event, channels) > 0)[0]
-                # Find out which index are negative so we dont count them accidently
-                valid_ind = np.nonzero(event < 0)[0]
-                if len(masked_ind):
-                    channels = np.delete(channels, masked_ind)
-                    self.main.automasked_hit += len(masked_ind)
-            else:
-                # So only positive values are considered
-                masked_ind = np.nonzero(np.take(event, channels) < 0)[0]
-                valid_ind = np.nonzero(event > 0)[0]
-                if len(masked_ind):
-                    channels = np.delete(channels, masked_ind)
-                    self.main.automasked_hit += len(masked_ind)
-
-        used_channels = np.zeros(self.main.numchan)  # To keep track which channel have been used already
-        numclus = 0  # The number of found clusters
-        clusters_list = []
-        clustersize = np.array([])
-        # Loop over all left channels which are a hit, here from "left" to "right"
-        for ch in channels:
-            if not used_channels[ch]:  # Make sure we dont count everything twice
-                used_channels[ch] = 1  # So now the channel is used
-                cluster = [ch]  # Keep track of the individual clusters
-                size = 1
-
-                right_stop = False
-                left_stop = False
-                # Now make a loop to find neighbouring hits of cluster,
-                # we must go into both directions
-                offset = int(self.main.max_clustersize * 0.5)
-                for i in range(1, offset + 1):  # Search plus minus the channel found Todo: first entry useless
-                    if 0 < ch - i and ch + i < self.main.numchan:  # To exclude overrun
-                        if np.abs(SN[ch + i]) > self.main.SN_cut * self.main.SN_ratio and not used_channels[
-                            ch + i] and ch + i in valid_ind and not right_stop:
-                            cluster.append(ch + i)
-                            used_channels[ch + i] = 1
-                            size += 1
-                        elif np.abs(SN[ch + i]) < self.main.SN_cut * self.main.SN_ratio:
-                            right_stop = True  # Prohibits search for to long clusters
-
-                        if np.abs(SN[ch - i]) > self.main.SN_cut * self.main.SN_ratio and not used_channels[
-                            ch - i] and ch - i in valid_ind and not left_stop:
-                            cluster.append(ch - i)
-                            used_channels[ch - i] = 1
-                            size += 1
-                        elif np.abs(SN[ch - i]) < self.main.SN_cut * self.main.SN_ratio:
-                            left_stop = True  # Prohibits search for to long clusters
-
-                # Now make a loop to find neighbouring hits of cluster, we must go into both directions
-                # TODO huge clusters can be misinterpreted!!! Takes huge amount of cpu, vectorize
-                # offset = int(self.max_clustersize / 2)
-                # for i in range(ch-offset, ch+offset): # Search plus minus the channel found
-                #    if 0 < i < self.numchan: # To exclude overrun
-                #            if np.abs(SN[i]) > self.SN_cut * self.SN_ratio and not used_channels[i] and i in valid_ind:
-                #                cluster.append(i)
-                #                used_channels[i] = 1
-                #                # Append the channel which is also hit after this estimation
-                #                size += 1
-
-                # Look if the cluster SN is big enough to be counted as clusters
-                Scluster = np.abs(np.sum(np.take(event, cluster)))
-                Ncluster = np.sqrt(np.abs(np.sum(np.take(Noise, cluster))))
-                SNcluster = Scluster / Ncluster  # Actual signal to noise of cluster
-                if SNcluster > self.main.SN_cluster:
-                    numclus += 1
-                    clusters_list.append(cluster)
-                    clustersize = np.append(clustersize, size)
-
-        # warning channels are only the channels which are above SN
-        return channels, clusters_list, numclus, clustersize
-
-    def process_event(self, event, pedestal, meanCMN, meanCMsig, noise, numchan=256):
-        """Processes single events"""
-
-        # Calculate the common mode noise for every channel
-        signal = event - pedestal  # Get the signal from event and subtract pedestal
-
-        # Mask noisy strips, by setting every noisy channel to 0 --> SN is always 0
-        signal[self.main.noise_analysis.noisy_strips] = 0
-
-        # Remove channels which have a signal higher then 5*CMsig+CMN which are not representative
-        prosignal = np.take(signal, np.nonzero(signal < (5 * meanCMsig + meanCMN)))  # Processed signal
-
-        if prosignal.any():
-            cmpro = np.mean(prosignal)
-            sigpro = np.std(prosignal)
-
-            corrsignal = signal - cmpro
-            SN = corrsignal / noise
-
-            return corrsignal, SN, cmpro, sigpro
+    def cluster(self, signal, SN, CMN, CMsig):
+        """Clusters common mode corrected events, e.g. when only the cluster cuts changed
+
+        :return: EventStore
+        """
+        if not self.main.usejit:
+            clustering = np_cluster_all_events
+            kwargs = {}
         else:
-            return np.zeros(numchan), np.zeros(numchan), 0, 0  # A default value return if everything fails
+            from analysis_classes.nb_analysis import cluster_all_events
+            clustering = cluster_all_events
+            kwargs = {"parallel": self.main.parallel_clustering}
+        hit_channels, hit_offsets, clus_event, clus_first, clus_size, _, _, automasked = \
+            clustering(signal, SN, self.main.noise, self.main.SN_cut, self.main.SN_ratio,
+                       self.main.SN_cluster, max_clustersize=self.main.max_clustersize,
+                       masking=self.main.masking, material=self.main.material, **kwargs)
+        self.main.automasked_hit += automasked
+        return EventStore.from_clusters(signal, SN, CMN, CMsig, hit_channels, hit_offsets,
+                                        clus_event, clus_first, clus_size, self.main.numchan, automasked)
 
     def plot_data(self, single_event=-1):
         """This function plots all data processed"""
         # COMMENT: every plot needs its own method!!!
+        import matplotlib.pyplot as plt
 
         for name, data in self.main.outputdata.items():
             # Plot a single event from every file
             if single_event > 0:
                 self.plot_single_event(single_event, name)
 
+            if isinstance(data["base"], EventAccumulator):
+                # Results of the streaming mode
+                histograms = data["base"]
+            else:
+                histograms = EventAccumulator(self.main.numchan)
+                histograms.add(data["base"])
+            hitmap = histograms.hitmap.counts
+            numclus_bins, numclus_counts = histograms.numclus.filled()
+            size_bins, size_counts = histograms.clustersize.filled()
+
             # Plot Analysis results
             fig = plt.figure("Analysis file: {!s}".format(name))
 
             # Plot Hitmap
             channel_plot = fig.add_subplot(211)
             channel_plot.bar(np.arange(self.main.numchan),
-                             data["base"]["Hitmap"][len(data["base"]["Hitmap"]) - 1], 1.,
+                             hitmap, 1.,
                              alpha=0.4, color="b")
             channel_plot.set_xlabel('channel [#]')
             channel_plot.set_ylabel('Hits [#]')
@@ -211,8 +266,7 @@ class BaseAnalysis:
 
             # Plot Number of clusters
             numclusters_plot = fig.add_subplot(221)
-            bin, counts = np.unique(data["base"]["Numclus"], return_counts=True)
-            numclusters_plot.bar(bin, counts, alpha=0.4, color="b")
+            numclusters_plot.bar(numclus_bins, numclus_counts, alpha=0.4, color="b")
             numclusters_plot.set_xlabel('Number of clusters [#]')
             numclusters_plot.set_ylabel('Occurance [#]')
             numclusters_plot.set_title('Number of clusters')
@@ -220,8 +274,7 @@ class BaseAnalysis:
 
             # Plot clustersizes
             clusters_plot = fig.add_subplot(222)
-            bin, counts = np.unique(np.concatenate(data["base"]["Clustersize"]), return_counts=True)
-            clusters_plot.bar(bin, counts, alpha=0.4, color="b")
+            clusters_plot.bar(size_bins, size_counts, alpha=0.4, color="b")
             clusters_plot.set_xlabel('Clustersize [#]')
             clusters_plot.set_ylabel('Occurance [#]')
             clusters_plot.set_title('Clustersizes')
@@ -234,6 +287,7 @@ class BaseAnalysis:
 
     def plot_single_event(self, eventnum, file):
         """ Plots a single event and its data"""
+        import matplotlib.pyplot as plt
 
         data = self.main.outputdata[file]
 
@@ -2,31 +2,50 @@
 # pylint: disable=C0103, R0902
 
 import logging			   
+import os
 from time import time
 import numpy as np
-from scipy.stats import norm
-import matplotlib.pyplot as plt
 from tqdm import tqdm
-from analysis_classes.nb_analysis import nb_noise_calc
-from analysis_classes.utilities import import_h5, gaussian, read_binary_Alibava
+from analysis_classes.utilities import import_h5, gaussian, read_binary_Alibava, iter_event_chunks, RunningStats
+from analysis_classes.histogram import Histogram
 
 
 class NoiseAnalysis:
     """This class contains all calculations and data concerning pedestals in 
 	ALIBAVA files"""
 
-    def __init__(self, path="", usejit=False, configs=None):
+    # Results which are stored in the cache, these are all results needed by the analysis and the plots
+    cached_results = ["numchan", "numevents", "pedestal", "noise", "noisy_strips", "good_strips", "CMnoise",
+                      "CMsig", "noise_corr", "median_noise"]
+
+    def __init__(self, path="", usejit=False, configs=None, cache=None):
         """
         :param path: Path to pedestal file
+        :param cache: ResultCache, if given the results are loaded from it or stored in it
         """
 		
         self.log = logging.getLogger()
         # Init parameters
         self.log.info("Loading pedestal file: {!s}".format(path))
+        self.cache = cache
+        self.cache_key = None
+        if cache is not None and os.path.exists(path):
+            self.cache_key = cache.key([path], Noise_cut=configs.get("Noise_cut", 5.),
+                                       Manual_mask=list(configs.get("Manual_mask", [])),
+                                       isBinary=configs["isBinary"])
+            results = cache.load(self.cache_key)
+            if results is not None:
+                self.configs = configs
+                self.data = None
+                self.load_results(results)
+                return
+
+        # Streaming mode: the pedestal run is processed in chunks of this size, 0 loads it at once
+        chunk_size = configs.get("chunk_size", 0)
         if not configs["isBinary"]:
             self.data = import_h5(path)[0]
         else:
-            self.data = read_binary_Alibava(path)
+            self.data = read_binary_Alibava(path, lazy=configs.get("memmap_binary", False) or bool(chunk_size))
 
         if self.data:
             # Some of the declaration may seem unecessary but it clears things up when you need to know how big some arrays are
@@ -39,10 +58,22 @@ class NoiseAnalysis:
                 self.data["events"]["time"][:] >= 0)  # Only use events with good timing, here always the case
             self.CMnoise = np.zeros(len(self.goodevents[0]), dtype=np.float32)
             self.CMsig = np.zeros(len(self.goodevents[0]), dtype=np.float32)
-            self.score = np.zeros((len(self.goodevents[0]), self.numchan),
-                                  dtype=np.float32)  # Variable needed for noise calculations
             self.configs = configs
             self.median_noise = None
+            # Histogram of the common mode corrected noise of all events and good strips
+            self.noise_hist = Histogram.linear(-50., 50., 500)
+
+            if chunk_size:
+                self.log.info("Calculating pedestal and Noise in chunks of {!s} events...".format(chunk_size))
+                start = time()
+                self.streaming_noise_calc(self.data["events"], chunk_size)
+                end = time()
+                self.log.warning("Time taken: {!s} seconds".format(round(abs(end - start), 2)))
+                self.store_results()
+                return
+
+            self.score = np.zeros((len(self.goodevents[0]), self.numchan),
+                                  dtype=np.float32)  # Variable needed for noise calculations
 
             # Calculate pedestal
             self.log.info("Calculating pedestal and Noise...")
@@ -56,15 +87,17 @@ class NoiseAnalysis:
                                                                            self.numevents, self.numchan)
                 self.noise = np.std(self.score_raw, axis=0)
                 self.noisy_strips, self.good_strips = self.detect_noisy_strips(self.noise, configs.get("Noise_cut", 5.))
-                # self.noise_corr = np.std(self.score, axis=0)
                 self.score_raw, self.CMnoise, self.CMsig = self.noise_calc(self.signal[:, self.good_strips],
                                                                            self.pedestal[self.good_strips],
                                                                            self.numevents,
                                                                            len(self.good_strips))
+                self.noise_corr = np.std(self.score_raw, axis=0)
+                self.noise_hist.add(self.score_raw)
                 end = time()
                 self.log.warning("Time taken: {!s} seconds".format(round(abs(end - start), 2)))
             else:
                 self.log.warning("Jit version used!!! No progress bar can be shown")
+                from analysis_classes.nb_analysis import nb_noise_calc
                 start = time()
                 self.score_raw, self.CMnoise, self.CMsig = nb_noise_calc(self.signal, self.pedestal)
                 self.noise = np.std(self.score_raw,
@@ -74,14 +107,28 @@ class NoiseAnalysis:
                 self.score, self.CMnoise, self.CMsig = nb_noise_calc(self.signal[:, self.good_strips],
                                                                      self.pedestal[self.good_strips])
                 self.noise_corr = np.std(self.score, axis=0)
+                self.noise_hist.add(self.score)
                 end = time()
                 self.log.warning("Time taken: {!s} seconds".format(round(abs(end - start), 2)))
-            self.total_noise = np.concatenate(self.score, axis=0)
-
+            self.store_results()
 
         else:
             self.log.warning("No valid file, skipping pedestal run")
 
+    def store_results(self):
+        """Stores the results in the cache, if there is one"""
+        if self.cache is not None and self.cache_key is not None:
+            results = {name: getattr(self, name) for name in self.cached_results}
+            results.update({"noise_hist_" + name: value for name, value in self.noise_hist.to_dict().items()})
+            self.cache.save(self.cache_key, results)
+
+    def load_results(self, results):
+        """Sets the results loaded from the cache"""
+        for name in self.cached_results:
+            setattr(self, name, results[name][()] if results[name].ndim == 0 else results[name])
+        self.noise_hist = Histogram.from_dict({name[len("noise_hist_"):]: value for name, value in results.items()
+                                               if name.startswith("noise_hist_")})
+
     def detect_noisy_strips(self, Noise, Noise_cut):
         """This function detects noisy strips and returns two arrays first
         array noisy strips, second array good strips"""
@@ -90,11 +137,42 @@ class NoiseAnalysis:
         # Calculate the
         self.median_noise = np.median(Noise)
         high_noise_strips = np.nonzero(Noise > self.median_noise + Noise_cut)[0]
-        high_noise_strips = np.append(high_noise_strips, self.configs.get("Manual_mask", []))
+        high_noise_strips = np.append(high_noise_strips, self.configs.get("Manual_mask", [])).astype(np.int32)
         good_strips = np.delete(good_strips, high_noise_strips)
 
         return np.array(high_noise_strips, dtype=np.int32), np.array(good_strips, dtype=np.int32)
 
+    def streaming_noise_calc(self, events, chunk_size):
+        """Pedestal and noise calculation chunk by chunk, without keeping the
+        signal or the score matrix in memory.
+        The noise of a channel is the std of signal - pedestal - CMN, where the CMN
+        is the mean over all channels. This equals the std of the signal minus its
+        event mean, so pedestal and noise are accumulated (Welford) in one pass.
+        A second pass calculates CMN and CMsig per event on the good strips."""
+        pedestal = RunningStats(self.numchan)
+        centered = RunningStats(self.numchan)
+        for _, signal, _ in iter_event_chunks(events, chunk_size):
+            pedestal.add(signal)
+            centered.add(signal - np.mean(signal, axis=1, dtype=np.float64)[:, None])
+        self.pedestal = pedestal.mean.astype(np.float32)
+        self.noise = centered.std().astype(np.float32)
+        self.noisy_strips, self.good_strips = self.detect_noisy_strips(self.noise,
+                                                                       self.configs.get("Noise_cut", 5.))
+
+        # Common mode of every event and noise after common mode correction on the good strips
+        score = RunningStats(len(self.good_strips))
+        self.CMnoise = np.zeros(self.numevents, dtype=np.float32)
+        self.CMsig = np.zeros(self.numevents, dtype=np.float32)
+        for start, signal, _ in iter_event_chunks(events, chunk_size):
+            cm = signal[:, self.good_strips] - self.pedestal[self.good_strips]
+            CMN = np.mean(cm, axis=1, dtype=np.float64)
+            self.CMnoise[start:start + len(cm)] = CMN
+            self.CMsig[start:start + len(cm)] = np.std(cm, axis=1, dtype=np.float64)
+            cn = cm - CMN[:, None]
+            score.add(cn)
+            self.noise_hist.add(cn)
+        self.noise_corr = score.std().astype(np.float32)
+
     def noise_calc(self, events, pedestal, numevents, numchannels):
         """Noise calculation, normal noise (NN) and common mode noise (CMN)
         Uses numpy, can be further optimized by reducing memory access to member variables.
@@ -125,6 +203,8 @@ class NoiseAnalysis:
     def plot_data(self):
 		# COMMENT: every plot needs its own method!!!											 
         """Plots the data calculated by the framework"""
+        import matplotlib.pyplot as plt
+        from scipy.stats import norm
 
         fig = plt.figure("Noise analysis")
 
@@ -174,7 +254,8 @@ class NoiseAnalysis:
 
         # Plot noise hist
         CM_plot = fig.add_subplot(224)
-        n, bins, patches = CM_plot.hist(self.total_noise, bins=500, density=False, alpha=0.4, color="b")
+        n, bins, patches = CM_plot.hist(self.noise_hist.edges[:-1], bins=self.noise_hist.edges,
+                                        weights=self.noise_hist.counts, density=False, alpha=0.4, color="b")
         CM_plot.set_yscale("log", nonposy='clip')
         CM_plot.set_ylim(1.)
 
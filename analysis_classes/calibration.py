@@ -7,13 +7,51 @@ from scipy.interpolate import CubicSpline
 from analysis_classes.utilities import *  # import_h5, read_binary_Alibava
 
 
+def batch_polyfit(x, y, deg):
+    """Least squares polynomial fit of y over every row of x, like np.polyfit(x[i], y, deg)
+    for all rows, but with one batched solve of the stacked Vandermonde matrices.
+
+    :param x: x values, one row per fit
+    :param y: y values shared by all fits
+    :param deg: degree of the polynomials
+    :return: coefficients (rows, deg+1), highest power first
+    """
+    vander = np.asarray(x, dtype=np.float64)[..., None] ** np.arange(deg, -1, -1)
+    # Scale the columns like np.polyfit does to improve the condition number
+    scale = np.sqrt(np.sum(vander ** 2, axis=-2))
+    scale[scale == 0] = 1.
+    coeff = np.matmul(np.linalg.pinv(vander / scale[..., None, :]), np.asarray(y, dtype=np.float64))
+    return coeff / scale
+
+
+def batch_polyval(coeff, x):
+    """Evaluates the polynomials of every row of coeff at x (Horner scheme)
+
+    :param coeff: coefficients (rows, deg+1), highest power first
+    :param x: values, broadcastable to (rows, ...)
+    """
+    x = np.asarray(x, dtype=np.float64)
+    shape = (len(coeff),) + (1,) * x.ndim
+    result = np.zeros(shape)
+    for power in np.asarray(coeff, dtype=np.float64).T:
+        result = result * x + power.reshape(shape)
+    return result
+
+
 class Calibration:
     """This class handles all concerning the calibration"""
 
-    def __init__(self, delay_path="", charge_path="", Noise_calc={}, isBinary=False):
+    # Results of the charge calibration which are stored in the cache
+    cached_results = ["meansig_charge", "chargecoeff", "meancoeff", "ADC_sig", "charge_sig", "strip_coeff", "gain"]
+
+    def __init__(self, delay_path="", charge_path="", Noise_calc={}, isBinary=False, lut_step=0., lut_max=1024.,
+                 cache=None):
         """
         :param delay_path: Path to calibration file
         :param charge_path: Path to calibration file
+        :param cache: ResultCache, if given the charge calibration is loaded from it or stored in it
+        :param lut_step: ADC resolution of the charge lookup table, 0 evaluates the polynomial for every value
+        :param lut_max: highest ADC value in the lookup table, higher values are evaluated with the polynomial
         """
 
         # self.charge_cal = None
@@ -25,16 +63,24 @@ class Calibration:
         # self.CMN = np.std(Noise_calc.CMnoise)
         self.chargecoeff = []
         self.meancoeff = None  # Mean coefficient out of all calibrations curves
+        self.strip_coeff = None  # Coefficients of every channel, masked channels get the mean coefficients
+        self.gain = None  # Gain of every channel in e- at 100 ADC
         self.meansig_charge = []  # mean per pulse per channel
         self.charge_sig = None  # Standard deviation of all charge calibartions
         self.delay_cal = []
         self.meansig_delay = []  # mean per pulse per channel
         self.isBinary = isBinary
         self.ADC_sig = None
+        self.lut_step = lut_step
+        self.lut = None  # Mean calibration curve tabulated every lut_step ADC
+        self.strip_lut = None  # Calibration curve of every channel, one row per channel
+        self.cache = cache
         self.log = logging.getLogger()
 
         if charge_path:
             self.charge_calibration_calc(charge_path)
+            if self.meancoeff is not None and lut_step:
+                self.build_lut(lut_step, lut_max)
         if delay_path:
             self.delay_calibration_calc(delay_path)
 
@@ -65,6 +111,18 @@ class Calibration:
     def charge_calibration_calc(self, charge_path):
         # Charge scan
         self.log.info("Loading charge calibration file: {!s}".format(charge_path))
+        cache_key = None
+        if self.cache is not None and os.path.exists(charge_path):
+            # The calibration depends on the pedestal and the masked strips as well
+            cache_key = self.cache.key([charge_path], arrays=[self.pedestal, self.noisy_channels],
+                                       isBinary=self.isBinary)
+            results = self.cache.load(cache_key)
+            if results is not None:
+                for name in self.cached_results:
+                    setattr(self, name, results[name])
+                self.charge_data = {"scan": {"value": results["pulses"]}}  # Only the scan values are plotted
+                return
+
         if not self.isBinary:
             self.charge_data = import_h5(charge_path)[0]
         else:
@@ -81,12 +139,9 @@ class Calibration:
 
             sigppulse = int(len(signals) / len(pulses))  # How many signals per pulses
 
-            start = 0
-            for i in range(sigppulse, len(signals) + sigppulse, sigppulse):
-                # Calculate the absolute value of the difference of each strip to the pedestal and mean it
-                raw = np.mean(np.abs(signals[start:i]), axis=0)
-                self.meansig_charge.append(raw)
-                start = i
+            # Calculate the absolute value of the difference of each strip to the pedestal and mean it per pulse
+            self.meansig_charge = np.mean(np.abs(signals[:len(pulses) * sigppulse]).reshape(len(pulses), sigppulse,
+                                                                                           -1), axis=1)
 
             # Set the zero value to a real 0 size otherwise a non physical error happens (Offset corretion)
             offset = self.meansig_charge[0]
@@ -97,19 +152,66 @@ class Calibration:
             # Interpolate and get some extrapolation data from polynomial fit (from alibava)
             data = np.array(self.meansig_charge).transpose()
             # datamoffset = data-data[0]
-            for pul in data:
-                self.chargecoeff.append(np.polyfit(pul, pulses, deg=4, full=False))
+            self.chargecoeff = batch_polyfit(data, pulses, deg=4)
             # print("Coefficients of charge fit: {!s}".format(self.chargecoeff))
             self.meancoeff = np.polyfit(np.mean(self.meansig_charge, axis=1), pulses, deg=4, full=False)
             self.ADC_sig = np.std(data, axis=0)
             self.charge_sig = np.polyval(self.meancoeff, self.ADC_sig)
-            self.chargecoeff = np.array(self.chargecoeff)
+            self.strip_coeff = np.tile(self.meancoeff, (len(self.pedestal), 1))
+            self.strip_coeff[np.delete(np.arange(len(self.pedestal)), self.noisy_channels)] = self.chargecoeff
+            self.gain = batch_polyval(self.strip_coeff, 100.)
+
+            if cache_key is not None:
+                results = {name: getattr(self, name) for name in self.cached_results}
+                results["pulses"] = pulses
+                self.cache.save(cache_key, results)
+
+    def build_lut(self, step, max_adc):
+        """Tabulates the mean and the per strip calibration curves from 0 to max_adc,
+        so converting ADC to electrons is a single gather. The values are rounded to
+        the next table entry, the error is at most gain*step/2."""
+        adc = np.arange(0., max_adc + step, step)
+        self.lut_step = step
+        self.lut = np.polyval(self.meancoeff, adc).astype(np.float32)
+        self.strip_lut = batch_polyval(self.strip_coeff, adc).astype(np.float32)
+        self.log.info("Calibration lookup table with {!s} entries per strip built".format(len(adc)))
+
+    def lut_index(self, x):
+        """Returns the index of ADC values in the lookup table and a mask of the values outside of it"""
+        index = (np.asarray(x) * (1. / self.lut_step) + 0.5).astype(np.intp)
+        outside = (index < 0) | (index >= len(self.lut))
+        if outside.any():
+            index[outside] = 0
+        return index, outside
 
     def charge_cal(self, x):
-        return np.polyval(self.meancoeff, x)
+        """Converts ADC to electrons with the mean calibration curve"""
+        if self.lut is None:
+            return np.polyval(self.meancoeff, x)
+        index, outside = self.lut_index(x)
+        charge = self.lut[index]
+        if outside.any():
+            charge = np.where(outside, np.polyval(self.meancoeff, x), charge)
+        return charge
+
+    def strip_charge_cal(self, x, channels):
+        """Converts ADC to electrons with the calibration curve of the strips.
+        Masked channels use the mean calibration curve, as do values outside of the table.
+
+        :param x: ADC values
+        :param channels: channel of every value (same shape as x)
+        """
+        if self.strip_lut is None:
+            raise ValueError("Per strip conversion needs a calibration lookup table (lut_step)")
+        index, outside = self.lut_index(x)
+        charge = self.strip_lut[channels, index]
+        if outside.any():
+            charge = np.where(outside, self.charge_cal(x), charge)
+        return charge
 
     def plot_data(self):
         """Plots the processed data"""
+        import matplotlib.pyplot as plt
 
         try:
             fig = plt.figure("Calibration")
@@ -144,9 +246,7 @@ class Calibration:
                 gain_plot.set_ylabel('Gain [e- at 100 ADC]')
                 gain_plot.set_title('Gain per Channel')
                 gain_plot.set_ylim(0, 70000)
-                gain = []
-                for coeff in self.chargecoeff:
-                    gain.append(np.polyval(coeff, 100.))
+                gain = np.delete(self.gain, self.noisy_channels)
 
                 gain_plot.bar(np.arange(len(self.pedestal) - len(self.noisy_channels)), gain, alpha=0.4, color="b",
                               label="Only non masked channels")
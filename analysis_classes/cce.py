@@ -3,46 +3,78 @@ efficiency"""
 
 import logging
 
-import matplotlib.pyplot as plt
+import numpy as np
+
+from analysis_classes.run_index import RunIndex
 
 
 class CCE:
-    """This function has actually plots the the CCE plot"""
+    """This function has actually plots the the CCE plot. The MPV of every run is kept
+    in a run index, with an index file (CCE: index) only new or changed runs of a series
+    are analysed, the curve is made from the index (see RunIndex)"""
+
+    # Config keys and plugins the results depend on (stage cache)
+    config_keys = ["CCE"]
+    depends_on = ["Langau"]
 
     def __init__(self, main_analysis):
         """Initialize some important parameters"""
         self.main = main_analysis
         self.data = self.main.outputdata.copy()
         self.log = logging.getLogger()
+        self.config = self.main.kwargs["configs"].get("CCE", {}) or {}
+        # MPV of a CCE of 100%, default the highest MPV of the series
+        self.reference = self.config.get("reference", 0)
+        # The index of the series mode, or one only for the runs of this analysis
+        self.index = getattr(self.main, "run_index", None)
+        if self.index is None:
+            self.index = RunIndex(None, self.config.get("pattern"))
+        self.settings = getattr(self.main, "series_settings", "")
+        self.series = getattr(self.main, "series", self.main.pathes)
 
     def run(self):
-        pass
+        """Enters the MPV of every analysed run into the index"""
+        for i, (file, path) in enumerate(zip(self.main.file_keys, self.main.pathes)):
+            langau = self.data.get(file, {}).get("Langau", {})
+            if "langau_coeff" not in langau:
+                self.log.warning("For the CCE the langau analysis has to be done prior. "
+                                 "No MPV of run {!s}".format(path))
+                continue
+            results = {"mpv": float(langau["langau_coeff"][0]),
+                       "mpv_error": float(np.sqrt(langau["langau_cov"][0][0]))}
+            if "langau_bootstrap" in langau:
+                # The bootstrap includes the uncertainty of the spectrum, not only of the fit
+                results["mpv_error"] = float(langau["langau_bootstrap"]["std"][0])
+                results["mpv_interval"] = [float(value) for value in langau["langau_bootstrap"]["mpv"]]
+            try:
+                header = str(self.main.data[i]["events"]["header"])
+            except (KeyError, TypeError, IndexError):
+                header = ""
+            self.index.update(path, self.settings, header=header, **results)
+        self.index.save()
+        # Nothing per file, the results are in the index (so the index is always updated)
+        return None
 
     def plot(self):
         """Plots the CCE"""
-
-        ypos = [0]  # x and y positions for the plot
-        xpos = [0]
-        y0 = 0
+        import matplotlib.pyplot as plt
+        voltage, mpv, error, names = self.index.curve(self.series)
+        if not len(mpv):
+            self.log.warning("No MPV in the run index, no CCE plot")
+            return
+        reference = self.reference or np.nanmax(mpv)
 
         fig = plt.figure("Charge collection efficiency (CCE)")
-
-        # Check if the langau has been calculated
-        # Loop over all processed data files
-        for path in self.main.pathes:
-            file = str(
-                path.split("\\")[-1].split('.')[0])  # Find the filename, warning these files must have been processed
-            if self.data[file]:
-                ypos.append(self.data[file]["langau"]["langau_coeff"][0])  # First value is the mpv
-                if not y0:
-                    y0 = ypos[-1]
-                ypos[-1] = ypos[-1] / y0
-                xpos.append(xpos[-1] + 1)  # Todo: make a good x axis here from the file name (regex)
-            else:
-                import warnings
-                warnings.warn(
-                    "For the CCE plot to work correctly the langau analysis has to be done prior. Suppression of output")
-
         plot = fig.add_subplot(111)
-        plot.set_title('Charge collection efficiency from file: {!s}'.format(file))
-        plot.plot(xpos, ypos, "r--", color="b")
\ No newline at end of file
+        plot.set_title('Charge collection efficiency of {!s} runs'.format(len(mpv)))
+        if np.isnan(voltage).any():
+            # Not every run has a voltage, the runs are labeled by name
+            voltage = np.arange(len(mpv))
+            plot.errorbar(voltage, mpv / reference, yerr=error / reference, fmt="o--", color="b")
+            plot.set_xticks(voltage)
+            plot.set_xticklabels(names, rotation=45, ha="right")
+            plot.set_xlabel("Run")
+        else:
+            plot.errorbar(voltage, mpv / reference, yerr=error / reference, fmt="o--", color="b")
+            plot.set_xlabel("Bias voltage [V]")
+        plot.set_ylabel("CCE")
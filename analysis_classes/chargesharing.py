@@ -6,15 +6,101 @@ import numpy as np
 import logging
 from tqdm import tqdm
 from scipy.stats import norm
-import matplotlib.pyplot as plt
 # from nb_analysisFunction import *
 from analysis_classes.utilities import convert_ADC_to_e
+from analysis_classes.histogram import Histogram, Histogram2D
+
+
+def eta_correction_table(eta_hist):
+    """Lookup table of the eta correction from an eta distribution (Histogram from 0 to 1).
+    The cumulative distribution at the bin edges maps eta to the position between the two
+    strips, for equally distributed hits. Without entries eta itself is the position.
+
+    :return: eta values, positions
+    """
+    if not eta_hist.entries:
+        return eta_hist.edges, eta_hist.edges.copy()
+    cumulative = np.zeros(len(eta_hist.edges))
+    cumulative[1:] = np.cumsum(eta_hist.counts) / float(eta_hist.entries)
+    return eta_hist.edges, cumulative
+
+
+def np_cluster_centres(member_charge, member_signal, cluster_members, cluster_offsets):
+    """Numpy version of nb_analysis.cluster_centres, with the same rules and output
+
+    :return: per cluster centre of gravity (nan without charge) and highest strip
+    """
+    if len(cluster_offsets) < 2:
+        return np.zeros(0), np.zeros(0, dtype=np.int64)
+    starts = cluster_offsets[:-1]
+    weight = np.add.reduceat(member_charge, starts)
+    weighted = np.add.reduceat(member_charge * cluster_members, starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cog = np.where(weight != 0., weighted / weight, np.nan)
+    # First strip with the largest signal of every cluster
+    largest = np.repeat(np.maximum.reduceat(member_signal, starts), np.diff(cluster_offsets))
+    index = np.where(member_signal == largest, np.arange(len(member_signal)), len(member_signal))
+    return cog, cluster_members[np.minimum.reduceat(index, starts)].astype(np.int64)
+
+
+def cluster_positions(store, eta_edges, eta_cumulative, charge_cal=None, usejit=False, parallel=False):
+    """Calculates the position of every cluster of an EventStore. The centre of gravity
+    uses the strips of the cluster, eta the highest strip of the cluster and its higher
+    neighbour (which may be outside of the cluster, e.g. for one strip clusters). The eta
+    corrected position is the left strip of the two plus the cumulative eta distribution at eta.
+
+    :param store: EventStore which kept the signal of the events
+    :param eta_edges: eta values of the lookup table of the eta correction
+    :param eta_cumulative: cumulative eta distribution at eta_edges (0 to 1)
+    :param charge_cal: conversion of ADC to electrons (Calibration.charge_cal), the same as
+                       for the eta distribution, None uses the signal in ADC
+    :param usejit: use the Numba kernel for the centre of gravity
+    :param parallel: if True, the clusters are distributed over all cores (prange)
+    :return: per cluster centre of gravity, eta of the two highest strips and eta corrected
+             position, all in strips, nan if the strips have no charge
+    """
+    if store.signal is None:
+        raise KeyError("The Signal of every event has not been kept")
+    numchan = store.signal.shape[1]
+
+    def charge(signal):
+        return convert_ADC_to_e(signal, charge_cal) if charge_cal is not None else np.abs(signal)
+
+    member_signal = np.abs(store.signal[np.repeat(store.cluster_event, np.diff(store.cluster_offsets)),
+                                        store.cluster_members])
+    member_charge = charge(member_signal)
+    if usejit:
+        from analysis_classes.nb_analysis import cluster_centres
+        cog, highest = cluster_centres(member_charge, member_signal, store.cluster_members,
+                                       store.cluster_offsets, parallel=parallel)
+    else:
+        cog, highest = np_cluster_centres(member_charge, member_signal, store.cluster_members,
+                                          store.cluster_offsets)
+
+    # The higher neighbour of the highest strip
+    def neighbour(channels):
+        return np.abs(store.signal[store.cluster_event, np.clip(channels, 0, numchan - 1)])
+    right = (highest == 0) | ((highest < numchan - 1) & (neighbour(highest + 1) >= neighbour(highest - 1)))
+    left = np.where(right, highest, highest - 1)
+    charge_left = charge(store.signal[store.cluster_event, left])
+    charge_right = charge(store.signal[store.cluster_event, left + 1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        total = charge_left + charge_right
+        eta = np.where(total != 0., charge_right / total, np.nan)
+    position = left + np.interp(eta, eta_edges, eta_cumulative)
+    return cog, eta, position
 
 
 class ChargeSharing:
     """ A class calculating the charge sharing between two strip clusters
     and plotting it into a histogram and a eta plot"""
 
+    # Config keys and plugins the results depend on (stage cache)
+    config_keys = ["chargesharing"]
+    depends_on = []
+    # Works with the accumulated data of the streaming mode as well
+    streaming = True
+
     def __init__(self, main_analysis):
         """Initialize some important parameters"""
         self.main = main_analysis
@@ -22,68 +108,68 @@ class ChargeSharing:
         self.data = self.main.outputdata.copy()
         self.results_dict = {}  # Containing all data processed
         self.log = logging.getLogger()
+        self.bins = self.main.kwargs["configs"].get("chargesharing", {}).get("bins", 200)
+        # Number of clusters converted at once
+        self.chunk_size = self.main.kwargs["configs"].get("chargesharing", {}).get("chunk_size", 1000000)
+        # Calculate the (eta corrected) position of every cluster
+        self.positions = self.main.kwargs["configs"].get("chargesharing", {}).get("positions", True)
 
     def run(self):
         """Runs the analysis"""
         for data in tqdm(self.data, desc="(chargesharing) Processing file:"):
             self.results_dict[data] = {}
-            # Get clustersizes of 2 and only events which show only one cluster in its data (just to be sure
-            indizes_clusters = np.nonzero(
-                self.data[data]["base"]["Numclus"] == 1)  # Indizes of events with the desired clusternumbers
-            clusters_raw = np.take(self.data[data]["base"]["Clustersize"], indizes_clusters)
-            clusters_flattend = np.concatenate(clusters_raw).ravel()  # so that they are easy accessible
-            indizes_clustersize = np.nonzero(
-                clusters_flattend == 2)  # Indizes of events with the desired clusternumbers
-            indizes = np.take(indizes_clusters, indizes_clustersize)[0]
-
-            # Data containing the al and ar values as list entries data[0] --> al
-            raw = np.take(self.data[data]["base"]["Signal"], indizes)
-            raw = np.reshape(np.concatenate(raw), (len(raw), self.main.numchan))
-            hits = np.concatenate(np.take(self.data[data]["base"]["Clusters"], indizes))
-            al = np.zeros(len(indizes))  # Amplitude left and right
-            ar = np.zeros(len(indizes))
-            il = np.min(hits, axis=1)  # Indizes of left and right
-            ir = np.max(hits, axis=1)
-            # final_data = np.zeros((len(indizes), 2))
-
-            for i, event, ali, ari, l, r in zip(range(len(al)), raw, al, ar, il, ir):
-                al[i] = event[l]  # So always the left strip is choosen
-                ar[i] = event[r]  # Same with the right strip
-
-            # Convert ADC to actual energy
-            al = convert_ADC_to_e(al, self.main.calibration.charge_cal)
-            ar = convert_ADC_to_e(ar, self.main.calibration.charge_cal)
-
-            final_data = np.array([al, ar])
-            eta = ar / (al + ar)
-            theta = np.arctan(ar / al)
-
-            # Calculate the gauss distributions
+            # Signal of the left and right strip of clusters of size 2 in events with only one cluster
+            amplitudes = self.data[data]["base"].two_strip_amplitudes(numclus=1)
+
+            eta_hist = Histogram.linear(0., 1., self.bins)
+            theta_hist = Histogram.linear(0., np.pi / 2, self.bins)
+            amplitude_hist = Histogram2D.linear((0., 50000.), (0., 50000.), 400)
+            for start in range(0, len(amplitudes), self.chunk_size):
+                # Convert ADC to actual energy, both strips at once
+                al, ar = convert_ADC_to_e(amplitudes[start:start + self.chunk_size],
+                                          self.main.calibration.charge_cal).T
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    eta = ar / (al + ar)
+                    theta = np.arctan(ar / al)
+                eta_hist.add(eta[np.isfinite(eta)])
+                theta_hist.add(theta[np.isfinite(theta)])
+                amplitude_hist.add(al, ar)
 
             # Cut the eta in two halves and fit gaussian to it
-            bins = 200
-            etahist, edges = np.histogram(eta, bins=bins)
+            etahist = eta_hist.counts
             length = len(etahist)
             mul, stdl = norm.fit(etahist[:int(length / 2)])
             mur, stdr = norm.fit(etahist[int(length / 2):])
 
-            self.results_dict[data]["data"] = final_data
-            self.results_dict[data]["eta"] = eta
-            self.results_dict[data]["theta"] = theta
-            self.results_dict[data]["fits"] = ((mul, stdl), (mur, stdr), edges, bins)
+            self.results_dict[data]["amplitudes"] = amplitude_hist
+            self.results_dict[data]["eta"] = eta_hist
+            self.results_dict[data]["theta"] = theta_hist
+            self.results_dict[data]["fits"] = ((mul, stdl), (mur, stdr), eta_hist.edges, self.bins)
+
+            # Positions of all clusters, corrected with the eta distribution of the two strip clusters
+            store = self.data[data]["base"]
+            if self.positions and getattr(store, "signal", None) is not None:
+                eta_table = eta_correction_table(eta_hist)
+                cog, eta, position = cluster_positions(store, *eta_table,
+                                                       charge_cal=self.main.calibration.charge_cal,
+                                                       usejit=self.main.usejit,
+                                                       parallel=getattr(self.main, "parallel_clustering", False))
+                self.results_dict[data]["eta_table"] = eta_table
+                self.results_dict[data]["positions"] = {"cog": cog, "eta": eta, "position": position}
 
         return self.results_dict.copy()
 
     def plot(self):
         """Plots all results"""
+        import matplotlib.pyplot as plt
 
         for file, data in self.results_dict.items():
             fig = plt.figure("Charge sharing from file: {!s}".format(file))
 
             # Plot delay
             plot = fig.add_subplot(221)
-            counts, xedges, yedges, im = plot.hist2d(data["data"][0, :], data["data"][1, :], bins=400,
-                                                     range=[[0, 50000], [0, 50000]])
+            amplitudes = data["amplitudes"]
+            im = plot.pcolormesh(amplitudes.xedges, amplitudes.yedges, amplitudes.counts.T)
             plot.set_xlabel('A_left (electrons)')
             plot.set_ylabel('A_right (electrons)')
             fig.colorbar(im)
@@ -94,16 +180,30 @@ class ChargeSharing:
             # right = stats.norm.pdf(data["fits"][2], loc=data["fits"][1][0], scale=data["fits"][1][1])
             # plot.plot(data["fits"][2][:100], left,"r--", color="r")
             # plot.plot(data["fits"][2], right,"r--", color="r")
+            plot.hist(data["eta"].edges[:-1], bins=data["eta"].edges, weights=data["eta"].counts, alpha=0.4, color="b")
             plot.set_xlabel('eta')
             plot.set_ylabel('entries')
             plot.set_title('Eta distribution')
 
             plot = fig.add_subplot(223)
+            plot.hist(data["theta"].edges[:-1] / np.pi, bins=data["theta"].edges / np.pi,
+                      weights=data["theta"].counts, alpha=0.4, color="b")
             plot.set_xlabel('theta/Pi')
             plot.set_ylabel('entries')
             plot.set_title('Theta distribution')
 
+            if "positions" in data:
+                plot = fig.add_subplot(224)
+                plot.hist(np.mod(data["positions"]["cog"], 1.), bins=100, range=(0., 1.), alpha=0.4,
+                          color="b", label="CoG")
+                plot.hist(np.mod(data["positions"]["position"], 1.), bins=100, range=(0., 1.), alpha=0.4,
+                          color="r", label="eta corrected")
+                plot.set_xlabel('interstrip position (strips)')
+                plot.set_ylabel('entries')
+                plot.set_title('Cluster positions')
+                plot.legend()
+
             fig.suptitle('Charge sharing analysis from file {!s}'.format(file))
             fig.tight_layout()
             fig.subplots_adjust(top=0.88)
-            # plt.draw()
\ No newline at end of file
+            # plt.draw()
@@ -0,0 +1,102 @@
+"""This file contains the scan of the clustering cuts. The common mode corrected
+events of a run are clustered again for every point of a grid of cut values"""
+# pylint: disable=C0103,R0913,R0914
+
+import itertools
+import logging
+
+import numpy as np
+
+from analysis_classes.BaseAnalysis import np_cluster_all_events
+from analysis_classes.event_store import EventStore
+from analysis_classes.histogram import Histogram
+from analysis_classes.langau import langau_fit
+from analysis_classes.nb_analysis import cluster_all_events
+from analysis_classes.shared_arrays import SharedArrays
+
+# Cuts which can be scanned, in the naming of the config
+SCAN_PARAMETERS = ["SN_cut", "SN_ratio", "SN_cluster", "max_cluster_size"]
+SCAN_DTYPE = np.dtype([(name, np.float64) for name in SCAN_PARAMETERS] +
+                      [("clusters_per_event", np.float64), ("mean_clustersize", np.float64),
+                       ("hits", np.int64), ("clusters", np.int64), ("mpv", np.float64)])
+
+
+def scan_grid(grid, defaults):
+    """All combinations of the scanned cut values, not scanned cuts keep their default
+
+    :param grid: dict with a list of values for the scanned cuts
+    :param defaults: dict with the value of every cut
+    :return: list of dicts with all cuts
+    """
+    values = [np.atleast_1d(grid.get(name, defaults[name])) for name in SCAN_PARAMETERS]
+    return [dict(zip(SCAN_PARAMETERS, point)) for point in itertools.product(*values)]
+
+
+def scan_point(shared, noise, cuts, masking, material, usejit, charge_coeff, numClus, Ecut, bins):
+    """Clusters the shared events with one set of cuts and returns its row of the scan table.
+    The mpv is fitted to the energy of the clusters in events with numClus clusters."""
+    signal, SN = shared["signal"], shared["SN"]
+    clustering = cluster_all_events if usejit else np_cluster_all_events
+    hit_channels, hit_offsets, clus_event, clus_first, clus_size, _, _, automasked = \
+        clustering(signal, SN, noise, cuts["SN_cut"], cuts["SN_ratio"], cuts["SN_cluster"],
+                   max_clustersize=int(cuts["max_cluster_size"]), masking=masking, material=material)
+    store = EventStore.from_clusters(signal, SN, shared["CMN"], shared["CMsig"], hit_channels, hit_offsets,
+                                     clus_event, clus_first, clus_size, len(noise), automasked)
+
+    # Energy of every cluster
+    charge = np.polyval(charge_coeff, np.abs(store.cluster_signal()))
+    energy = np.add.reduceat(charge, store.cluster_offsets[:-1]) if len(charge) else np.zeros(0)
+    energy = energy[np.isin(store.numclus[store.cluster_event], numClus) & (energy > 0) & (energy < Ecut)]
+    energy_hist = Histogram.linear(0., Ecut, bins).add(energy)
+    mpv = np.nan
+    if energy_hist.entries:
+        try:
+            mpv = langau_fit(energy_hist.counts, energy_hist.edges)[0][0]
+        except (RuntimeError, ValueError):
+            pass  # Fit failed, e.g. too few clusters
+
+    return tuple(cuts[name] for name in SCAN_PARAMETERS) + (
+        np.mean(store.numclus) if store.numevents else 0.,
+        np.mean(store.cluster_size) if len(store.cluster_size) else 0.,
+        len(store.hit_channels), len(store.cluster_size), mpv)
+
+
+def cut_scan(store, noise, grid, defaults, masking=True, material=1, usejit=False, charge_coeff=None,
+             numClus=(1,), Ecut=150000, bins=500, Pool=None):
+    """Clusters the events of a run for every point of a grid of cuts. The common mode
+    corrected signal and SN are calculated once (store) and shared with the workers.
+
+    :param store: EventStore with signal and SN of the run
+    :param noise: noise of every channel
+    :param grid: dict with a list of values for the scanned cuts (SCAN_PARAMETERS)
+    :param defaults: dict with the value of every cut
+    :param charge_coeff: coefficients of the mean charge calibration (ADC to electrons)
+    :param numClus: number of clusters of the events used for the mpv
+    :param Pool: process pool, the grid points are distributed over its workers
+    :return: structured array (SCAN_DTYPE) with one row per grid point
+    """
+    points = scan_grid(grid, defaults)
+    if charge_coeff is None:
+        charge_coeff = np.array([1., 0.])  # Without calibration the mpv is given in ADC
+    with SharedArrays(sum(getattr(store, name).nbytes for name in EventStore.common_mode_columns)) as shared:
+        for name in EventStore.common_mode_columns:
+            shared.share(name, getattr(store, name))
+        params = [(shared, np.asarray(noise, dtype=np.float32), point, masking, material, usejit,
+                   charge_coeff, list(numClus), Ecut, bins) for point in points]
+        if Pool is not None:
+            rows = Pool.starmap(scan_point, params, chunksize=1)
+        else:
+            rows = [scan_point(*param) for param in params]
+    table = np.array(rows, dtype=SCAN_DTYPE)
+
+    log = logging.getLogger()
+    log.info("Cut scan over {!s} settings:\n{!s}".format(len(table), format_scan_table(table)))
+    return table
+
+
+def format_scan_table(table):
+    """Returns the scan table as text with one line per setting"""
+    lines = ["".join("{:>20s}".format(name) for name in table.dtype.names)]
+    for row in table:
+        lines.append("".join("{:>20.4g}".format(value) for value in row))
+    return "\n".join(lines)
@@ -0,0 +1,188 @@
+"""This file contains the columnar store for the processed events of a run"""
+# pylint: disable=C0103,R0902,R0913
+
+import numpy as np
+
+
+def split_flat(values, offsets):
+    """Splits a flat array at the offsets into an object array of sub arrays
+
+    :param values: flat array
+    :param offsets: array of len(sub arrays)+1 start offsets, last entry is len(values)
+    :return: object array containing the sub arrays
+    """
+    result = np.empty(len(offsets) - 1, dtype=object)
+    for i, part in enumerate(np.split(values, offsets[1:-1])):
+        result[i] = part
+    return result
+
+
+class EventStore:
+    """Stores the processed data of a run column wise.
+
+    Per event quantities are dense arrays (signal and SN as float32 matrices of
+    shape (events, channels), CMN, CMsig and the number of clusters as 1D
+    arrays). The variable length data is stored flat with offsets (CSR like):
+    the hit channels of event i are hit_channels[hit_offsets[i]:hit_offsets[i+1]],
+    cluster j consists of cluster_members[cluster_offsets[j]:cluster_offsets[j+1]]
+    and belongs to event cluster_event[j].
+
+    Like Bdata, the columns can be accessed via store['label'], with the labels
+    of the former per event array. For the variable length columns object
+    arrays with one entry per event are built on access."""
+
+    labels = ["Signal", "SN", "CMN", "CMsig", "Hitmap", "Channel_hit", "Clusters", "Numclus", "Clustersize"]
+    # Columns of the common mode correction and of the clustering, e.g. to store them separately
+    common_mode_columns = ["signal", "SN", "CMN", "CMsig"]
+    cluster_columns = ["hit_channels", "hit_offsets", "cluster_event", "cluster_members", "cluster_offsets",
+                       "automasked"]
+
+    def __init__(self, signal, SN, CMN, CMsig, hit_channels, hit_offsets,
+                 cluster_event, cluster_members, cluster_offsets, numchan, automasked=0):
+        """
+        :param signal: common mode corrected signal (events, channels), may be None
+        :param SN: signal to noise (events, channels), may be None
+        :param CMN: common mode per event
+        :param CMsig: common mode standard deviation per event
+        :param hit_channels: flat array of the channels above the SN cut
+        :param hit_offsets: offsets of the events in hit_channels (events+1)
+        :param cluster_event: event number of every cluster
+        :param cluster_members: flat array of the channels of all clusters
+        :param cluster_offsets: offsets of the clusters in cluster_members (clusters+1)
+        :param numchan: number of channels
+        :param automasked: number of automasked hits
+        """
+        self.signal = None if signal is None else np.asarray(signal, dtype=np.float32)
+        self.SN = None if SN is None else np.asarray(SN, dtype=np.float32)
+        self.CMN = np.asarray(CMN, dtype=np.float32)
+        self.CMsig = np.asarray(CMsig, dtype=np.float32)
+        self.hit_channels = np.asarray(hit_channels, dtype=np.int32)
+        self.hit_offsets = np.asarray(hit_offsets, dtype=np.int64)
+        self.cluster_event = np.asarray(cluster_event, dtype=np.int64)
+        self.cluster_members = np.asarray(cluster_members, dtype=np.int32)
+        self.cluster_offsets = np.asarray(cluster_offsets, dtype=np.int64)
+        self.numchan = numchan
+        self.automasked = automasked
+
+        self.numevents = len(self.hit_offsets) - 1
+        self.cluster_size = np.diff(self.cluster_offsets).astype(np.int32)
+        self.numclus = np.bincount(self.cluster_event, minlength=self.numevents).astype(np.int32)
+        self.hitmap = np.bincount(self.hit_channels, minlength=numchan).astype(np.float64)
+
+    @classmethod
+    def from_clusters(cls, signal, SN, CMN, CMsig, hit_channels, hit_offsets,
+                      clus_event, clus_first, clus_size, numchan, automasked=0):
+        """Builds the store from the flat output of the batch clustering kernel,
+        where every cluster is given by its first strip and its size"""
+        cluster_offsets = np.zeros(len(clus_size) + 1, dtype=np.int64)
+        cluster_offsets[1:] = np.cumsum(clus_size)
+        members = (np.repeat(clus_first, clus_size)
+                   + np.arange(cluster_offsets[-1]) - np.repeat(cluster_offsets[:-1], clus_size))
+        return cls(signal, SN, CMN, CMsig, hit_channels, hit_offsets,
+                   clus_event, members, cluster_offsets, numchan, automasked)
+
+    @classmethod
+    def concatenate(cls, stores):
+        """Merges stores of consecutive event ranges into one store"""
+        event_shift = np.cumsum([0] + [store.numevents for store in stores])
+        hit_shift = np.cumsum([0] + [len(store.hit_channels) for store in stores])
+        member_shift = np.cumsum([0] + [len(store.cluster_members) for store in stores])
+        dense = all(store.signal is not None for store in stores)
+
+        return cls(np.concatenate([store.signal for store in stores]) if dense else None,
+                   np.concatenate([store.SN for store in stores]) if dense else None,
+                   np.concatenate([store.CMN for store in stores]),
+                   np.concatenate([store.CMsig for store in stores]),
+                   np.concatenate([store.hit_channels for store in stores]),
+                   np.concatenate([[0]] + [store.hit_offsets[1:] + shift
+                                           for store, shift in zip(stores, hit_shift)]),
+                   np.concatenate([store.cluster_event + shift for store, shift in zip(stores, event_shift)]),
+                   np.concatenate([store.cluster_members for store in stores]),
+                   np.concatenate([[0]] + [store.cluster_offsets[1:] + shift
+                                           for store, shift in zip(stores, member_shift)]),
+                   stores[0].numchan,
+                   sum(store.automasked for store in stores))
+
+    @classmethod
+    def from_dict(cls, columns, numchan):
+        """Builds the store from a dict with the columns (see to_dict)"""
+        columns = dict(columns)
+        columns["automasked"] = int(columns["automasked"])
+        return cls(numchan=numchan, **{name: columns[name]
+                                       for name in cls.common_mode_columns + cls.cluster_columns})
+
+    def to_dict(self, columns=None):
+        """Returns the columns (default all) as dict of arrays"""
+        return {name: getattr(self, name)
+                for name in columns or self.common_mode_columns + self.cluster_columns}
+
+    def __len__(self):
+        return self.numevents
+
+    def __getitem__(self, arg=None):
+        if arg:
+            return self.get(arg)
+
+    def __repr__(self):
+        return "<EventStore: {!s} events, {!s} clusters>".format(self.numevents, len(self.cluster_event))
+
+    def event_cluster_offsets(self):
+        """Offsets of the events in the cluster arrays (clusters are ordered by event)"""
+        offsets = np.zeros(self.numevents + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(self.numclus)
+        return offsets
+
+    def cluster_signal(self):
+        """Signal of every cluster member, flat like cluster_members"""
+        if self.signal is None:
+            raise KeyError("The Signal of every event has not been kept")
+        return self.signal[np.repeat(self.cluster_event, self.cluster_size), self.cluster_members]
+
+    def hit_signal(self):
+        """Signal of every hit channel, flat like hit_channels"""
+        if self.signal is None:
+            raise KeyError("The Signal of every event has not been kept")
+        return self.signal[np.repeat(np.arange(self.numevents), np.diff(self.hit_offsets)), self.hit_channels]
+
+    def two_strip_amplitudes(self, numclus=1):
+        """Signal of the left and right strip of every cluster of size two, only events with
+        numclus clusters are considered. The members of a cluster are sorted, so the
+        first one is the left strip.
+
+        :return: array (clusters, 2) with the left and right signal
+        """
+        if self.signal is None:
+            raise KeyError("The Signal of every event has not been kept")
+        clusters = np.nonzero((self.cluster_size == 2) & (self.numclus[self.cluster_event] == numclus))[0]
+        left = self.cluster_members[self.cluster_offsets[clusters]]
+        events = self.cluster_event[clusters]
+        return np.stack([self.signal[events, left], self.signal[events, left + 1]], axis=1)
+
+    def get(self, label):
+        """Returns the column of the label, like Bdata does"""
+        if label in ("Signal", "SN"):
+            column = self.signal if label == "Signal" else self.SN
+            if column is None:
+                raise KeyError("The {!s} of every event has not been kept".format(label))
+            return column
+        if label == "CMN":
+            return self.CMN
+        if label == "CMsig":
+            return self.CMsig
+        if label == "Numclus":
+            return self.numclus
+        if label == "Hitmap":
+            # Hitmap of the whole run
+            return self.hitmap
+        if label == "Channel_hit":
+            return split_flat(self.hit_channels, self.hit_offsets)
+        if label == "Clustersize":
+            return split_flat(self.cluster_size, self.event_cluster_offsets())
+        if label == "Clusters":
+            members = split_flat(self.cluster_members, self.cluster_offsets)
+            offsets = self.event_cluster_offsets()
+            clusters = np.empty(self.numevents, dtype=object)
+            for i in range(self.numevents):
+                clusters[i] = list(members[offsets[i]:offsets[i + 1]])
+            return clusters
+        raise KeyError("Unknown label: {!s}".format(label))
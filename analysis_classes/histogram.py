@@ -0,0 +1,173 @@
+"""This file contains a mergeable histogram with fixed bins, which can be
+filled chunk by chunk instead of keeping all values for a plot or a fit"""
+# pylint: disable=C0103
+
+import numpy as np
+
+
+class Histogram:
+    """Histogram with fixed edges and int64 counts.
+
+    Values are added incrementally and histograms with the same edges can be
+    merged, e.g. the ones of different chunks or worker processes. Like
+    np.histogram the last bin includes its right edge, values outside of the
+    edges are counted in underflow and overflow. A weighted histogram sums up
+    a weight per value in every bin as well, e.g. the errors of the values."""
+
+    def __init__(self, edges, weighted=False):
+        """
+        :param edges: monotonically increasing bin edges
+        :param weighted: sum up the weights of the values per bin
+        """
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+        self.sums = np.zeros(len(self.counts)) if weighted else None
+        self.underflow = 0
+        self.overflow = 0
+
+    @classmethod
+    def linear(cls, low, high, bins, weighted=False):
+        """Histogram with equally sized bins between low and high"""
+        return cls(np.linspace(low, high, bins + 1), weighted)
+
+    @classmethod
+    def integer(cls, low, high):
+        """Histogram with one bin for every integer value from low to high-1"""
+        return cls(np.arange(low, high + 1) - 0.5)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Restores a histogram from the output of to_dict"""
+        hist = cls(data["edges"], "sums" in data)
+        hist.counts[:] = data["counts"]
+        if hist.sums is not None:
+            hist.sums[:] = data["sums"]
+        hist.underflow = int(data["underflow"])
+        hist.overflow = int(data["overflow"])
+        return hist
+
+    def __repr__(self):
+        return "<Histogram: {!s} bins, {!s} entries>".format(len(self.counts), self.entries)
+
+    @property
+    def entries(self):
+        """Number of values in the bins (without under- and overflow)"""
+        return int(self.counts.sum())
+
+    @property
+    def centers(self):
+        """Bin centers"""
+        return (self.edges[1:] + self.edges[:-1]) * 0.5
+
+    def bin_index(self, values):
+        """Index of the bin of every value, -1 and len(counts) for values outside"""
+        index = np.searchsorted(self.edges, values, side="right") - 1
+        # The right edge belongs to the last bin
+        index[values == self.edges[-1]] = len(self.counts) - 1
+        return index
+
+    def add(self, values, weights=None):
+        """Adds all values of an array (of any shape) to the histogram
+
+        :param values: values to add
+        :param weights: weight of every value (same shape), only for weighted histograms
+        """
+        values = np.ravel(values)
+        index = self.bin_index(values)
+        inside = (index >= 0) & (index < len(self.counts))
+        self.underflow += int(np.count_nonzero(values < self.edges[0]))
+        self.overflow += int(np.count_nonzero(values > self.edges[-1]))
+        self.counts += np.bincount(index[inside], minlength=len(self.counts))
+        if self.sums is not None:
+            if weights is None:
+                raise ValueError("A weighted histogram needs the weights of the values")
+            self.sums += np.bincount(index[inside], weights=np.ravel(weights)[inside],
+                                     minlength=len(self.counts))
+        return self
+
+    def merge(self, other):
+        """Adds the counts of a histogram with the same edges"""
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError("Histograms with different edges cannot be merged")
+        if (self.sums is None) != (other.sums is None):
+            raise ValueError("Weighted and unweighted histograms cannot be merged")
+        self.counts += other.counts
+        if self.sums is not None:
+            self.sums += other.sums
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+        return self
+
+    def filled(self):
+        """Bin centers and counts of the bins which are not empty, like np.unique
+        with return_counts would give them for integer histograms"""
+        index = np.nonzero(self.counts)[0]
+        return self.centers[index], self.counts[index]
+
+    def means(self):
+        """Mean weight of the values in every bin, 0 for empty bins"""
+        if self.sums is None:
+            raise ValueError("Only weighted histograms have mean weights")
+        means = np.zeros(len(self.counts))
+        np.divide(self.sums, self.counts, out=means, where=self.counts > 0)
+        return means
+
+    def to_dict(self):
+        """Returns the histogram as dict of numpy arrays, e.g. for np.savez or h5py"""
+        data = {"edges": self.edges, "counts": self.counts,
+                "underflow": np.int64(self.underflow), "overflow": np.int64(self.overflow)}
+        if self.sums is not None:
+            data["sums"] = self.sums
+        return data
+
+
+class Histogram2D:
+    """Two dimensional histogram with fixed edges and int64 counts, values outside
+    of the edges are dropped. Like Histogram it is filled incrementally and
+    histograms with the same edges can be merged."""
+
+    def __init__(self, xedges, yedges):
+        """
+        :param xedges: monotonically increasing bin edges of the first axis
+        :param yedges: monotonically increasing bin edges of the second axis
+        """
+        self.x = Histogram(xedges)
+        self.y = Histogram(yedges)
+        self.counts = np.zeros((len(self.x.counts), len(self.y.counts)), dtype=np.int64)
+
+    @classmethod
+    def linear(cls, xrange, yrange, bins):
+        """Histogram with bins x bins equally sized bins in the ranges (low, high)"""
+        return cls(np.linspace(xrange[0], xrange[1], bins + 1), np.linspace(yrange[0], yrange[1], bins + 1))
+
+    def __repr__(self):
+        return "<Histogram2D: {!s} bins, {!s} entries>".format(self.counts.shape, self.entries)
+
+    @property
+    def xedges(self):
+        return self.x.edges
+
+    @property
+    def yedges(self):
+        return self.y.edges
+
+    @property
+    def entries(self):
+        """Number of value pairs in the bins"""
+        return int(self.counts.sum())
+
+    def add(self, x, y):
+        """Adds all value pairs of two arrays (of the same shape) to the histogram"""
+        xindex = self.x.bin_index(np.ravel(x))
+        yindex = self.y.bin_index(np.ravel(y))
+        inside = (xindex >= 0) & (xindex < self.counts.shape[0]) & (yindex >= 0) & (yindex < self.counts.shape[1])
+        flat = xindex[inside] * self.counts.shape[1] + yindex[inside]
+        self.counts += np.bincount(flat, minlength=self.counts.size).reshape(self.counts.shape)
+        return self
+
+    def merge(self, other):
+        """Adds the counts of a histogram with the same edges"""
+        if not (np.array_equal(self.xedges, other.xedges) and np.array_equal(self.yedges, other.yedges)):
+            raise ValueError("Histograms with different edges cannot be merged")
+        self.counts += other.counts
+        return self
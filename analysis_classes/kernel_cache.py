@@ -0,0 +1,174 @@
+"""This file contains the warm up of the Numba kernels into a shared cache folder.
+By default Numba caches the kernels next to the sources, which fails on read only
+installs, so every process (e.g. every worker of the pool) compiles them again"""
+# pylint: disable=C0103
+
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+from time import time
+
+import numpy as np
+
+# Numba reads the cache folder from this variable, worker processes inherit it
+CACHE_DIR_VARIABLE = "NUMBA_CACHE_DIR"
+
+# Modules with cached kernels, their cache location is fixed when they are imported
+KERNEL_MODULES = ["analysis_classes.nb_analysis", "analysis_classes.langau_model"]
+
+
+def set_cache_dir(directory):
+    """Sets the cache folder of the Numba kernels for this process and all processes
+    started afterwards. Has to be called before the kernels are imported.
+
+    :param directory: cache folder, created if it does not exist
+    """
+    log = logging.getLogger()
+    directory = os.path.abspath(os.path.normpath(directory))
+    os.makedirs(directory, exist_ok=True)
+    previous = os.environ.get(CACHE_DIR_VARIABLE)
+    os.environ[CACHE_DIR_VARIABLE] = directory
+    if "numba" in sys.modules:
+        import numba
+        numba.config.CACHE_DIR = directory
+    imported = [module for module in KERNEL_MODULES if module in sys.modules]
+    if imported and previous != directory:
+        log.warning("The kernels of {!s} are already imported and keep their cache folder".format(imported))
+    return directory
+
+
+def warm_up_calls(parallel=True):
+    """Calls of the kernels with the dtypes of the analysis (float32 events, float64
+    fits), through the same wrappers as the analysis so the signatures match.
+
+    :param parallel: compile the prange flavours as well
+    :return: list of (kernel name, function without arguments)
+    """
+    from analysis_classes.event_store import EventStore
+    from analysis_classes.chargesharing import cluster_positions
+    from analysis_classes.nb_analysis import cluster_all_events
+
+    rng = np.random.RandomState(0)
+    numchan = 256
+    noise = np.full(numchan, 3., dtype=np.float32)
+    signal = rng.normal(0, 3, (20, numchan)).astype(np.float32)
+    signal[:, 100:102] = -60.
+    SN = signal / noise
+    clusters = {}
+
+    def clustering(flavour):
+        result = cluster_all_events(signal, SN, noise, 5., 0.5, 6., 5, True, 1, parallel=flavour)
+        hit_channels, hit_offsets, clus_event, clus_first, clus_size, _, _, automasked = result
+        clusters[flavour] = EventStore.from_clusters(signal, SN, np.zeros(len(signal), dtype=np.float32),
+                                                     np.zeros(len(signal), dtype=np.float32), hit_channels,
+                                                     hit_offsets, clus_event, clus_first, clus_size, numchan,
+                                                     automasked)
+
+    def centres(flavour):
+        edges = np.linspace(0., 1., 11)
+        cluster_positions(clusters[flavour], edges, edges, usejit=True, parallel=flavour)
+
+    def fit_model():
+        from analysis_classes.langau_model import langau, langau_jacobian
+        x = np.linspace(0., 60000., 50)
+        langau(x, 20000., 2000., 1000., 100.)
+        langau_jacobian(x, 20000., 2000., 1000., 100.)
+
+    calls = [("nb_cluster_all_events", lambda: clustering(False)),
+             ("nb_cluster_centres", lambda: centres(False))]
+    if parallel:
+        calls += [("nb_cluster_all_events_parallel", lambda: clustering(True)),
+                  ("nb_cluster_centres_parallel", lambda: centres(True))]
+    calls.append(("langau, langau_jacobian", fit_model))
+    return calls
+
+
+def kernel_stats():
+    """Number of cache hits and misses of all kernels which are imported"""
+    try:
+        from numba.core.dispatcher import Dispatcher
+    except ImportError:  # numba < 0.49
+        from numba.dispatcher import Dispatcher
+    hits, misses = 0, 0
+    for name in KERNEL_MODULES:
+        module = sys.modules.get(name)
+        if module is None:
+            continue
+        for kernel in vars(module).values():
+            if isinstance(kernel, Dispatcher):
+                hits += sum(kernel.stats.cache_hits.values())
+                misses += sum(kernel.stats.cache_misses.values())
+    return hits, misses
+
+
+def warm_up(parallel=True):
+    """Compiles (or loads from the cache) every kernel once
+
+    :param parallel: compile the prange flavours as well
+    :return: list of (kernel name, seconds, "compiled", "cached" or "in memory")
+    """
+    report = []
+    for name, call in warm_up_calls(parallel):
+        hits, misses = kernel_stats()
+        start = time()
+        call()
+        seconds = time() - start
+        new_hits, new_misses = kernel_stats()
+        if new_misses > misses:
+            source = "compiled"
+        elif new_hits > hits:
+            source = "cached"
+        else:
+            source = "in memory"  # Already in this process, e.g. through an other kernel
+        report.append((name, seconds, source))
+    return report
+
+
+def copy_folder(source, destination):
+    """Copies all files of a folder into an other, existing folder (shutil.copytree
+    only merges into an existing folder from python 3.8 on)"""
+    for root, _, files in os.walk(source):
+        target = os.path.join(destination, os.path.relpath(root, source))
+        os.makedirs(target, exist_ok=True)
+        for file in files:
+            shutil.copy2(os.path.join(root, file), os.path.join(target, file))
+
+
+def _fresh_warm_up(directory, parallel):
+    """Warm up in a new process, so nothing is compiled or loaded yet"""
+    os.environ[CACHE_DIR_VARIABLE] = directory
+    return warm_up(parallel)
+
+
+def precompile(directory, parallel=True):
+    """Compiles all kernels into the cache folder, which is then shared by all processes
+    (see set_cache_dir). The kernels are compiled in a new process into an empty folder,
+    which is copied into the cache folder, and loaded in an other new process from the
+    cache folder, so the report always has both times.
+
+    :param directory: cache folder
+    :param parallel: compile the prange flavours as well
+    :return: list of (kernel name, compile seconds, cached load seconds)
+    """
+    log = logging.getLogger()
+    directory = set_cache_dir(directory)
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with context.Pool(1) as pool:
+            compiled = pool.apply(_fresh_warm_up, (temp_dir, parallel))
+        copy_folder(temp_dir, directory)
+    with context.Pool(1) as pool:
+        cached = pool.apply(_fresh_warm_up, (directory, parallel))
+
+    report = [(name, compile_time, load_time)
+              for (name, compile_time, _), (_, load_time, _) in zip(compiled, cached)]
+    log.info("Numba kernels compiled into {!s}:".format(directory))
+    for name, compile_time, load_time in report:
+        log.info("    {:<38s} compile: {:8.3f} s   cached load: {:8.3f} s".format(name, compile_time, load_time))
+    misses = [name for (name, _, source) in cached if source == "compiled"]
+    if misses:
+        log.warning("Kernels which were compiled again instead of loaded from the cache: {!s}".format(misses))
+    return report
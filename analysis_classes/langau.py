@@ -3,22 +3,189 @@
 # pylint: disable=C0103,E1101,R0913
 
 import logging
-import pylandau
 import warnings
 
-import matplotlib.pyplot as plt
 import numpy as np
 from scipy.optimize import curve_fit
 from tqdm import tqdm
 
 # from nb_analysisFunction import *
-from analysis_classes.utilities import convert_ADC_to_e
+from analysis_classes.utilities import convert_ADC_to_e, cluster_energies
+from analysis_classes.histogram import Histogram
+from analysis_classes.langau_model import langau, langau_jacobian, HALF_WIDTH_SIGMA, \
+    HALF_WIDTH_LEFT, HALF_WIDTH_RIGHT
+
+
+def langau_start_values(x, hist):
+    """Start values of a fit from the spectrum. The mpv is the vertex of the parabola
+    through the highest bin and its neighbours, eta and sigma follow from the widths
+    at half maximum left and right of it and A is the height of the highest bin.
+
+    :param x: positions of the bins
+    :param hist: counts of the bins
+    :return: mpv, eta, sigma, A
+    """
+    peak = int(np.argmax(hist))
+    A = float(hist[peak])
+    mpv = x[peak]
+    if 0 < peak < len(hist) - 1:
+        curvature = hist[peak - 1] - 2. * hist[peak] + hist[peak + 1]
+        if curvature < 0:
+            mpv += 0.5 * (hist[peak - 1] - hist[peak + 1]) / curvature * (x[peak + 1] - x[peak])
+
+    # Positions where the spectrum crosses half of the maximum, interpolated between the bins
+    below = np.flatnonzero(hist < 0.5 * A)
+    left_bins, right_bins = below[below < peak], below[below > peak]
+    if not len(left_bins) or not len(right_bins):
+        return mpv, 1500., 5000., A
+    i, j = left_bins[-1], right_bins[0]
+    left = x[i] + (0.5 * A - hist[i]) / (hist[i + 1] - hist[i]) * (x[i + 1] - x[i])
+    right = x[j - 1] + (hist[j - 1] - 0.5 * A) / (hist[j - 1] - hist[j]) * (x[j] - x[j - 1])
+
+    # The ratio of the half widths only depends on sigma/eta
+    ratio = (right - mpv) / max(mpv - left, 1.)
+    ratios = HALF_WIDTH_RIGHT / HALF_WIDTH_LEFT
+    sigma_eta = np.interp(ratio, ratios[::-1], HALF_WIDTH_SIGMA[::-1])
+    eta = (mpv - left) / np.interp(sigma_eta, HALF_WIDTH_SIGMA, HALF_WIDTH_LEFT)
+    return mpv, max(eta, 1.), max(sigma_eta * eta, 1.), A
+
+
+def langau_fit(hist, edges):
+    """Fits the langau to a histogram, starting at the first bin above a third of the maximum.
+    The start values come from the shape of the spectrum, the fit is repeated with the
+    last results as start values until the mpv changes less than 100 electrons.
+
+    :param hist: counts of the bins
+    :param edges: bin edges
+    :return: coefficients (mpv, eta, sigma, A) and their covariance matrix
+    """
+    # Cut off noise part
+    lancut = np.max(hist) * 0.33  # Find maximum of hist and get the cut
+    ind_xmin = np.flatnonzero(hist > lancut)[0]  # Finds the first element which is higher as threshold
+    x = edges[ind_xmin:-1].astype(float)
+    y = hist[ind_xmin:].astype(float)
+
+    coeff = langau_start_values(x, y)
+    oldmpv = coeff[0]
+    for _ in range(50):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            coeff, pcov = curve_fit(langau, x, y, p0=coeff, jac=langau_jacobian, absolute_sigma=True,
+                                    bounds=(1, 500000))
+        if abs(coeff[0] - oldmpv) <= 100:
+            break
+        oldmpv = coeff[0]
+    else:
+        warnings.warn("Langau has not converged after 50 attempts!")
+
+    return coeff, pcov
+
+
+def langau_fit_job(hist, edges):
+    """langau_fit for the fitting scheduler, a failed fit gives nan values instead of an exception"""
+    try:
+        return langau_fit(hist, edges)
+    except (RuntimeError, ValueError, IndexError) as err:
+        logging.getLogger().warning("Langau fit failed: {!s}".format(err))
+        return np.full(4, np.nan), np.full((4, 4), np.nan)
+
+
+def fit_langau_spectra(spectra, pool=None):
+    """Fits the langau to every spectrum. The fits are independent of each other and are
+    distributed over the workers of the pool, the results do not depend on the number of workers.
+
+    :param spectra: dict of Histograms
+    :param pool: process pool, None fits one spectrum after the other
+    :return: dict with the keys of spectra and (coefficients, covariance matrix) as values
+    """
+    keys = list(spectra)
+    params = [(spectra[key].counts, spectra[key].edges) for key in keys]
+    if pool is not None and len(params) > 1:
+        results = pool.starmap(langau_fit_job, params, chunksize=1)
+    else:
+        results = [langau_fit_job(*param) for param in params]
+    return dict(zip(keys, results))
+
+
+def bootstrap_job(hist, edges, seed, replicas):
+    """Fits the langau to bootstrap replicas of a spectrum. A replica resamples the entries
+    with replacement, drawn as multinomial with the bin contents as probabilities, which
+    is the same as resampling the energies and filling the histogram again.
+
+    :param hist: counts of the bins
+    :param edges: bin edges
+    :param seed: sequence of ints, replica i is drawn with RandomState(seed + [i])
+    :param replicas: numbers of the replicas
+    :return: coefficients of the replicas (replicas, 4), nan if a fit failed
+    """
+    entries = int(np.sum(hist))
+    coeffs = np.full((len(replicas), 4), np.nan)
+    # Nothing to resample, e.g. a cluster size without clusters, all fits failed
+    if not entries:
+        return coeffs
+    probabilities = np.asarray(hist, dtype=np.float64) / entries
+    for i, replica in enumerate(replicas):
+        resample = np.random.RandomState(list(seed) + [replica]).multinomial(entries, probabilities)
+        coeffs[i] = langau_fit_job(resample, edges)[0]
+    return coeffs
+
+
+def bootstrap_langau_spectra(spectra, replicas, seed=0, pool=None, chunk_size=10):
+    """Bootstraps the langau fits of every spectrum. The replicas are fitted in chunks
+    distributed over the workers of the pool. Every replica has its own seed, so the
+    results only depend on the seed and not on the number of workers.
+
+    :param spectra: dict of Histograms
+    :param replicas: number of replicas per spectrum
+    :param seed: seed of the run
+    :param pool: process pool, None fits one replica after the other
+    :param chunk_size: replicas per task
+    :return: dict with the keys of spectra and the coefficients of the replicas as values
+    """
+    keys, params = [], []
+    for number, key in enumerate(spectra):
+        for start in range(0, replicas, chunk_size):
+            keys.append(key)
+            params.append((spectra[key].counts, spectra[key].edges, [seed, number],
+                           range(start, min(start + chunk_size, replicas))))
+    if pool is not None and len(params) > 1:
+        results = pool.starmap(bootstrap_job, params, chunksize=1)
+    else:
+        results = [bootstrap_job(*param) for param in params]
+
+    coefficients = {key: [] for key in spectra}
+    for key, result in zip(keys, results):
+        coefficients[key].append(result)
+    return {key: np.concatenate(parts) if parts else np.zeros((0, 4)) for key, parts in coefficients.items()}
+
+
+def bootstrap_intervals(coefficients, confidence=0.68):
+    """Central confidence intervals of mpv, eta and sigma from the bootstrap replicas
+
+    :param coefficients: coefficients of the replicas (replicas, 4)
+    :param confidence: probability content of the intervals
+    :return: dict with the intervals (low, high), the standard deviations and the
+             number of failed fits
+    """
+    good = coefficients[~np.isnan(coefficients).any(axis=1)]
+    if len(good):
+        tail = 50. * (1. - confidence)
+        low, high = np.percentile(good, [tail, 100. - tail], axis=0)
+        std = np.std(good, axis=0)
+    else:
+        low = high = std = np.full(4, np.nan)
+    return {"replicas": coefficients, "failed": len(coefficients) - len(good), "confidence": confidence,
+            "mpv": (low[0], high[0]), "eta": (low[1], high[1]), "sigma": (low[2], high[2]), "std": std}
 
 
 class Langau:
     """This class calculates the langau distribution and returns the best values for landau and Gauss fit to the data
     """
 
+    # Config keys and plugins the results depend on (stage cache)
+    config_keys = ["langau", "max_cluster_size"]
+    depends_on = []
+
     def __init__(self, main_analysis):
         """Gets the main analysis class and imports all things needed for its calculations"""
 
@@ -33,6 +200,12 @@ class Langau:
         self.bins = self.main.kwargs["configs"].get("langau", {}).get("bins", 500)
         self.Ecut = self.main.kwargs["configs"].get("langau", {}).get("energyCutOff", 150000)
         self.plotfit = self.main.kwargs["configs"].get("langau", {}).get("fitLangau", True)
+        # Fit the spectrum of every clustersize as well
+        self.fit_clustersizes = self.main.kwargs["configs"].get("langau", {}).get("fitClustersizes", False)
+        # Number of bootstrap replicas of every fitted spectrum, 0 turns the bootstrap off
+        self.bootstrap = self.main.kwargs["configs"].get("langau", {}).get("bootstrap", 0)
+        self.bootstrap_seed = self.main.kwargs["configs"].get("langau", {}).get("bootstrapSeed", 0)
+        self.bootstrap_confidence = self.main.kwargs["configs"].get("langau", {}).get("bootstrapConfidence", 0.68)
 
     def run(self):
         """Calculates the langau for the specified data"""
@@ -46,204 +219,120 @@ class Langau:
             clustersize_list = list(
                 range(1, self.main.kwargs["configs"]["max_cluster_size"] + 1))  # If nothing is specified
 
+        spectra = {}  # All spectra which are fitted, the fits are done at once in the end
+
         # Go over all datafiles
         for data in tqdm(self.data, desc="(langau) Processing file:"):
             self.results_dict[data] = {}
-            indNumClus = self.get_num_clusters(self.data[data],
-                                               self.numClusters)  # Here events with only one cluster are choosen
-            indizes = np.concatenate(indNumClus)
-            valid_events_clustersize = np.take(self.data[data]["base"]["Clustersize"], indizes)
-            valid_events_clusters = np.take(self.data[data]["base"]["Clusters"], indizes)
-            valid_events_Signal = np.take(self.data[data]["base"]["Signal"],
-                                          indizes)  # Get the clustersizes of valid events
-            # Get events which show only cluster in its data
+            store = self.data[data]["base"]
             charge_cal, noise = self.main.calibration.charge_cal, self.main.noise
-            self.results_dict[data]["Clustersize"] = []
-
-            # General langau, where all clustersizes are considered
-            if self.main.usejit and self.poolsize > 1:
-                paramslist = []
-                for size in clustersize_list:
-                    cls_ind = np.nonzero(valid_events_clustersize == size)[0]
-                    paramslist.append((cls_ind, valid_events_Signal, valid_events_clusters,
-                                       self.main.calibration.charge_cal, self.main.noise))
 
-                # Here multiple cpu calculate the energy of the events per clustersize
-                results = self.pool.starmap(langau_cluster, paramslist,
-                                            chunksize=1)
-
-
-                self.results_dict[data]["Clustersize"] = results
-
-            else:
-                for size in tqdm(clustersize_list, desc="(langau) Processing clustersize"):
-                    # get the events with the different clustersizes
-                    ClusInd = [[], []]
-                    for i, event in enumerate(valid_events_clustersize):
-                        # cls_ind = np.nonzero(valid_events_clustersize == size)[0]
-                        for j, clus in enumerate(event):
-                            if clus == size:
-                                ClusInd[0].extend([i])
-                                ClusInd[1].extend([j])
-
-                    signal_clst_event = []
-                    noise_clst_event = []
-                    for i, ind in tqdm(enumerate(ClusInd[0]), desc="(langau) Processing event"):
-                        y = ClusInd[1][i]
-                        # Signal calculations
-                        signal_clst_event.append(np.take(valid_events_Signal[ind], valid_events_clusters[ind][y]))
-                        # Noise Calculations
-                        noise_clst_event.append(
-                            np.take(noise, valid_events_clusters[ind][y]))  # Get the Noise of an event
-
-                    totalE = np.sum(convert_ADC_to_e(signal_clst_event, charge_cal), axis=1)
-                    totalNoise = np.sqrt(np.sum(convert_ADC_to_e(noise_clst_event, charge_cal),
-                                                axis=1))  # eError is a list containing electron signal noise
-
-                    # incrementor += 1
-
-                    preresults = {"signal": totalE, "noise": totalNoise}
-
-                    self.results_dict[data]["Clustersize"].append(preresults)
+            # Energy of all clusters at once, then only the clusters of events with the
+            # desired number of clusters are considered, separately for every clustersize
+            clusters = cluster_energies(store, charge_cal, noise)
+            valid = np.isin(store.numclus[store.cluster_event], self.numClusters)
+            self.results_dict[data]["Clustersize"] = []
+            for size in clustersize_list:
+                selected = valid & (store.cluster_size == size)
+                self.results_dict[data]["Clustersize"].append({"signal": clusters["signal"][selected],
+                                                               "noise": clusters["noise"][selected]})
 
             # With all the data from every clustersize add all together and fit the langau to it
             finalE = np.zeros(0)
             finalNoise = np.zeros(0)
-            for cluster in self.results_dict[data]["Clustersize"]:
-                indi = np.nonzero(cluster["signal"] > 0)[0]  # Clean up and extra energy cut
-                nogarbage = cluster["signal"][indi]
-                indi = np.nonzero(nogarbage < self.Ecut)[0]  # ultra_high_energy_cut
+            energy_hist = self.energy_histogram()
+            for i, cluster in enumerate(self.results_dict[data]["Clustersize"]):
+                # Clean up and ultra_high_energy_cut, the noise of the clusters is cut as well
+                indi = np.nonzero((cluster["signal"] > 0) & (cluster["signal"] < self.Ecut))[0]
                 cluster["signal"] = cluster["signal"][indi]
+                cluster["noise"] = cluster["noise"][indi]
+                cluster["histogram"] = self.energy_histogram().add(cluster["signal"])
+                energy_hist.merge(cluster["histogram"])
                 finalE = np.append(finalE, cluster["signal"])
                 finalNoise = np.append(finalNoise, cluster["noise"])
+                if self.fit_clustersizes:
+                    spectra[(data, i)] = cluster["histogram"]
 
-            # Fit the langau to it
-
-            coeff, pcov, hist, error_bins = self.fit_langau(finalE, finalNoise, bins=self.bins)
+            # The langau is fitted to it in the end
+            spectra[(data, "all")] = energy_hist
             self.results_dict[data]["signal"] = finalE
+            self.results_dict[data]["histogram"] = energy_hist
             self.results_dict[data]["noise"] = finalNoise
-            self.results_dict[data]["langau_coeff"] = coeff
-            self.results_dict[data]["langau_data"] = [np.arange(1., 100000., 1000.),
-                                                      pylandau.langau(np.arange(1., 100000., 1000.),
-                                                                      *coeff)]  # aka x and y data
-            self.results_dict[data]["data_error"] = error_bins
+            if finalNoise.any():
+                self.results_dict[data]["data_error"] = self.calc_hist_errors(finalE, finalNoise, energy_hist.edges)
+            else:
+                self.results_dict[data]["data_error"] = np.array([])
 
             # Consider now only the seedcut hits for the langau,
             if self.main.kwargs["configs"].get("langau", {}).get("seed_cut_langau", False):
-                seed_cut_channels = self.data[data]["base"]["Channel_hit"]
-                signals = self.data[data]["base"]["Signal"]
-                finalE = []
-                seedcutADC = []
-                for i, signal in enumerate(tqdm(signals, desc="(langau SC) Processing events")):
-                    if signal[seed_cut_channels[i]].any():
-                        seedcutADC.append(signal[seed_cut_channels[i]])
-
+                # Sum of the converted signal of the hit channels of every event with hits
+                hits = np.diff(store.hit_offsets)
                 self.log.info("Converting ADC to electrons...")
-                converted = convert_ADC_to_e(seedcutADC, charge_cal)
-                for conv in converted:
-                    finalE.append(sum(conv))
-                finalE = np.array(finalE, dtype=np.float32)
+                converted = convert_ADC_to_e(store.hit_signal(), charge_cal)
+                if len(converted):
+                    finalE = np.add.reduceat(converted, store.hit_offsets[:-1][hits > 0]).astype(np.float32)
+                else:
+                    finalE = np.array([], dtype=np.float32)
 
                 # get rid of 0 events
                 indizes = np.nonzero(finalE > 0)[0]
                 nogarbage = finalE[indizes]
                 indizes = np.nonzero(nogarbage < self.Ecut)[0]  # ultra_high_energy_cut
-                coeff, pcov, hist, error_bins = self.fit_langau(nogarbage[indizes], bins=self.bins)
-                # coeff, pcov, hist, error_bins = self.fit_langau(nogarbage, bins=500)
+                energy_hist = self.energy_histogram().add(nogarbage[indizes])
+                spectra[(data, "SC")] = energy_hist
                 self.results_dict[data]["signal_SC"] = nogarbage[indizes]
-                self.results_dict[data]["langau_coeff_SC"] = coeff
-                self.results_dict[data]["langau_data_SC"] = [np.arange(1., 100000., 1000.),
-                                                             pylandau.langau(np.arange(1., 100000., 1000.),
-                                                                             *coeff)]  # aka x and y data
+                self.results_dict[data]["histogram_SC"] = energy_hist
+
+        # Fit all spectra, in parallel if there is a pool
+        self.log.info("Fitting the langau to {!s} spectra...".format(len(spectra)))
+        fits = fit_langau_spectra(spectra, self.pool if self.poolsize > 1 else None)
+        if self.bootstrap:
+            self.log.info("Fitting {!s} bootstrap replicas of every spectrum...".format(self.bootstrap))
+            replicas = bootstrap_langau_spectra(spectra, self.bootstrap, self.bootstrap_seed,
+                                                self.pool if self.poolsize > 1 else None)
+        for (data, spectrum), (coeff, pcov) in fits.items():
+            if spectrum == "all":
+                results = self.results_dict[data]
+                suffix = ""
+            elif spectrum == "SC":
+                results = self.results_dict[data]
+                suffix = "_SC"
+            else:
+                results = self.results_dict[data]["Clustersize"][spectrum]
+                suffix = ""
+            results["langau_coeff" + suffix] = coeff
+            results["langau_cov" + suffix] = pcov
+            results["langau_data" + suffix] = [np.arange(1., 100000., 1000.),
+                                               langau(np.arange(1., 100000., 1000.), *coeff)]  # aka x and y data
+            if self.bootstrap:
+                intervals = bootstrap_intervals(replicas[(data, spectrum)], self.bootstrap_confidence)
+                results["langau_bootstrap" + suffix] = intervals
+                self.log.info("Langau {!s} {!s}: MPV {:.0f}, {:.0%} interval {:.0f} - {:.0f}".format(
+                    data, spectrum, coeff[0], self.bootstrap_confidence, *intervals["mpv"]))
 
         return self.results_dict.copy()
 
-    def fit_langau(self, x, errors=np.array([]), bins=500):
-        """Fits the langau to data"""
-        hist, edges = np.histogram(x, bins=bins)
-        if errors.any():
-            binerror = self.calc_hist_errors(x, errors, edges)
-        else:
-            binerror = np.array([])
-
-        # Cut off noise part
-        lancut = np.max(hist) * 0.33  # Find maximum of hist and get the cut
-        # TODO: Bug when using optimized vs non optimized !!!
-        try:
-            ind_xmin = np.argwhere(hist > lancut)[0][
-                0]  # Finds the first element which is higher as threshold optimized
-        except:
-            ind_xmin = np.argwhere(hist > lancut)[
-                0]  # Finds the first element which is higher as threshold non optimized
-
-        mpv, eta, sigma, A = 27000, 1500, 5000, np.max(hist)
-
-        # Fit with constrains
-        converged = False
-        iter = 0
-        oldmpv = 0
-        diff = 100
-        while not converged:
-            iter += 1
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                # create a text trap and redirect stdout
-                # Warning: astype(float) is importanmt somehow, otherwise funny error happens one
-                # some machines where it tells you double_t and float are not possible
-                coeff, pcov = curve_fit(pylandau.langau, edges[ind_xmin:-1].astype(float),
-                                        hist[ind_xmin:].astype(float), absolute_sigma=True, p0=(mpv, eta, sigma, A),
-                                        bounds=(1, 500000))
-            if abs(coeff[0] - oldmpv) > diff:
-                mpv, eta, sigma, A = coeff
-                oldmpv = mpv
-            else:
-                converged = True
-            if iter > 50:
-                converged = True
-                warnings.warn("Langau has not converged after 50 attempts!")
-
-        return coeff, pcov, hist, binerror
-
-    def get_num_clusters(self, data, num_cluster):
-        """
-        Get all clusters which seem important- Here custers with numclus will be returned
-        :param data: data file which should be searched
-        :param num_cluster: number of cluster which should be considered. 0 makes no sense
-        :return: list of data indizes after cluster consideration (so basically eventnumbers which are good)
-        """
-        events = []
-        for clus in num_cluster:
-            events.append(
-                np.nonzero(data["base"]["Numclus"] == clus)[0])  # Indizes of events with the desired clusternumbers
-
-        return events
+    def energy_histogram(self):
+        """Empty energy spectrum, all spectra share these bins so they can be merged"""
+        return Histogram.linear(0., self.Ecut, self.bins)
 
     def calc_hist_errors(self, x, errors, bins):
-        """Calculates the errors for the bins in a histogram if error of simple point is known"""
-        errorBins = np.zeros(len(bins) - 1)
-        binsize = bins[1] - bins[0]
-
-        iter = 0
-        for ind in bins:
-            if ind != bins[-1]:
-                ind_where_bin = np.where((x >= ind) & (x < (binsize + ind)))[0]
-                # mu, std = norm.fit(self.CMnoise)
-                if ind_where_bin.any():
-                    errorBins[iter] = np.mean(np.take(errors, ind_where_bin))
-                iter += 1
-
-        return errorBins
+        """Calculates the errors for the bins in a histogram if error of simple point is known,
+        the error of a bin is the mean error of its points"""
+        return Histogram(bins, weighted=True).add(x, errors).means()
 
     def plot(self):
         """Plots the data calculated so the energy data and the langau"""
+        import matplotlib.pyplot as plt
 
         for file, data in self.results_dict.items():
             fig = plt.figure("Langau from file: {!s}".format(file))
 
             # Plot delay
             plot = fig.add_subplot(111)
-            hist, edges = np.histogram(data["signal"], bins=self.bins)
-            plot.hist(data["signal"], bins=self.bins, density=False, alpha=0.4, color="b", label="All clusters")
+            hist, edges = data["histogram"].counts, data["histogram"].edges
+            plot.hist(edges[:-1], bins=edges, weights=hist, density=False, alpha=0.4, color="b",
+                      label="All clusters")
             plot.errorbar(edges[:-1], hist, xerr=data["data_error"], fmt='o', markersize=1, color="red")
             if self.plotfit:
                 plot.plot(data["langau_data"][0], data["langau_data"][1], "r--",
@@ -262,7 +351,8 @@ class Langau:
             colour = ['green', 'red', 'orange', 'cyan', 'black', 'pink', 'magenta']
             for i, cls in enumerate(data["Clustersize"]):
                 if i < 7:
-                    plot.hist(cls["signal"], bins=self.bins, density=False, alpha=0.3, color=colour[i],
+                    plot.hist(cls["histogram"].edges[:-1], bins=cls["histogram"].edges,
+                              weights=cls["histogram"].counts, density=False, alpha=0.3, color=colour[i],
                               label="Clustersize: {!s}".format(i + 1))
                 else:
                     warnings.warn(
@@ -279,7 +369,9 @@ class Langau:
                 # Plot Seed cut langau
                 plot = fig.add_subplot(111)
                 # indizes = np.nonzero(data["signal_SC"] > 0)[0]
-                plot.hist(data["signal_SC"], bins=self.bins, density=False, alpha=0.4, color="b", label="Seed clusters")
+                plot.hist(data["histogram_SC"].edges[:-1], bins=data["histogram_SC"].edges,
+                          weights=data["histogram_SC"].counts, density=False, alpha=0.4, color="b",
+                          label="Seed clusters")
                 if self.plotfit:
                     plot.plot(data["langau_data_SC"][0], data["langau_data_SC"][1], "r--", color="g",
                             label="Langau: \n mpv: {mpv!s} \n eta: {eta!s} \n sigma: {sigma!s} \n A: {A!s} \n".format(
@@ -0,0 +1,239 @@
+"""This file contains a compiled Landau-Gauss model for the fits of energy spectra.
+It is parametrized like pylandau.langau (mpv is the position and A the height of
+the maximum), but the Landau distribution is tabulated once, the scaling to mpv
+and A is done in compiled code as well and the fit gets the Jacobian of the model."""
+# pylint: disable=C0103
+
+import numpy as np
+from numba import njit
+
+# Coefficients of the rational approximations of the Landau density (CERNLIB DENLAN)
+P1 = np.array([0.4259894875, -0.1249762550, 0.03984243700, -0.006298287635, 0.001511162253])
+Q1 = np.array([1.0, -0.3388260629, 0.09594393323, -0.01608042283, 0.003778942063])
+P2 = np.array([0.1788541609, 0.1173957403, 0.01488850518, -0.001394989411, 0.0001283617211])
+Q2 = np.array([1.0, 0.7428795082, 0.3153932961, 0.06694219548, 0.008790609714])
+P3 = np.array([0.1788544503, 0.09359161662, 0.006325387654, 0.00006611667319, -0.000002031049101])
+Q3 = np.array([1.0, 0.6097809921, 0.2560616665, 0.04746722384, 0.006957301675])
+P4 = np.array([0.9874054407, 118.6723273, 849.2794360, -743.7792444, 427.0262186])
+Q4 = np.array([1.0, 106.8615961, 337.6496214, 2016.712389, 1597.063511])
+P5 = np.array([1.003675074, 167.5702434, 4789.711289, 21217.86767, -22324.94910])
+Q5 = np.array([1.0, 156.9424537, 3745.310488, 9834.698876, 66924.28357])
+P6 = np.array([1.000827619, 664.9143136, 62972.92665, 475554.6998, -5743609.109])
+Q6 = np.array([1.0, 651.4101098, 56974.73333, 165917.4725, -2815759.939])
+A1 = np.array([0.04166666667, -0.01996527778, 0.02709538966])
+A2 = np.array([-1.845568670, -4.284640743])
+
+INV_SQRT_2PI = 0.3989422804014
+
+# Widths at half maximum left and right of the peak of langau(x, 0, 1, sigma, 1) for
+# some sigma (all in units of eta), used to get start values of fits from a spectrum
+HALF_WIDTH_SIGMA = np.array([0., 0.25, 0.5, 0.75, 1., 1.5, 2., 3., 4., 6., 8., 12., 16.])
+HALF_WIDTH_LEFT = np.array([1.364, 1.406, 1.531, 1.721, 1.951, 2.471, 3.024, 4.167, 5.327,
+                            7.665, 10.012, 14.713, 19.419])
+HALF_WIDTH_RIGHT = np.array([2.654, 2.672, 2.727, 2.826, 2.969, 3.358, 3.828, 4.88, 5.995,
+                             8.288, 10.612, 15.292, 19.986])
+
+
+def _rational(p, q, v):
+    return (p[0] + (p[1] + (p[2] + (p[3] + p[4] * v) * v) * v) * v) / \
+           (q[0] + (q[1] + (q[2] + (q[3] + q[4] * v) * v) * v) * v)
+
+
+def landau_pdf(v):
+    """Density of the standard Landau distribution (numpy array v)"""
+    v = np.asarray(v, dtype=np.float64)
+    density = np.zeros(v.shape)
+    edges = [-np.inf, -5.5, -1., 1., 5., 12., 50., 300., np.inf]
+    for i, (low, high) in enumerate(zip(edges[:-1], edges[1:])):
+        inside = (v >= low) & (v < high)
+        x = v[inside]
+        if i == 0:
+            u = np.exp(x + 1.0)
+            with np.errstate(divide="ignore", over="ignore", invalid="ignore"):
+                value = 0.3989422803 * (np.exp(-1 / u) / np.sqrt(u)) * (1 + (A1[0] + (A1[1] + A1[2] * u) * u) * u)
+            density[inside] = np.where(u < 1e-10, 0., value)
+        elif i == 1:
+            u = np.exp(-x - 1)
+            density[inside] = np.exp(-u) * np.sqrt(u) * _rational(P1, Q1, x)
+        elif i in (2, 3):
+            density[inside] = _rational(P2, Q2, x) if i == 2 else _rational(P3, Q3, x)
+        elif i in (4, 5, 6):
+            u = 1 / x
+            density[inside] = u * u * _rational([P4, P5, P6][i - 4], [Q4, Q5, Q6][i - 4], u)
+        else:
+            u = 1 / (x - x * np.log(x) / (x + 1))
+            density[inside] = u * u * (1 + (A2[0] + A2[1] * u) * u)
+    return density
+
+
+def landau_table(start, step, size):
+    """Tabulates the standard Landau distribution on an equally spaced grid, the rows
+    are the cumulative distribution function, the first moment (integral of v times
+    the density) and the density. The integrals are summed up with Simpson's rule."""
+    v = start + np.arange(size) * step
+    table = np.zeros((3, size))
+    table[2] = landau_pdf(v)
+    center = landau_pdf(v[1:] - 0.5 * step)
+    table[0, 1:] = np.cumsum(step / 6. * (table[2, :-1] + 4. * center + table[2, 1:]))
+    table[1, 1:] = np.cumsum(step / 6. * ((v[1:] - step) * table[2, :-1] +
+                                          4. * (v[1:] - 0.5 * step) * center + v[1:] * table[2, 1:]))
+    return table
+
+
+# The Landau distribution is tabulated once, on the first use, a langau only needs table lookups then
+TABLE_START = -8.
+TABLE_STEP = 0.01
+TABLE_SIZE = 100801
+_landau_table = None
+
+
+def get_landau_table():
+    """The tabulated Landau distribution (see landau_table), built on the first call"""
+    global _landau_table
+    if _landau_table is None:
+        _landau_table = landau_table(TABLE_START, TABLE_STEP, TABLE_SIZE)
+    return _landau_table
+
+
+@njit(cache=True)
+def _hermite(value0, value1, slope0, slope1, t):
+    """Cubic Hermite interpolation between two grid points of the table and its derivative"""
+    value = (2 * t ** 3 - 3 * t ** 2 + 1) * value0 + (t ** 3 - 2 * t ** 2 + t) * slope0 + \
+            (3 * t ** 2 - 2 * t ** 3) * value1 + (t ** 3 - t ** 2) * slope1
+    slope = (6 * t ** 2 - 6 * t) * (value0 - value1) + (3 * t ** 2 - 4 * t + 1) * slope0 + \
+            (3 * t ** 2 - 2 * t) * slope1
+    return value, slope / TABLE_STEP
+
+
+@njit(cache=True)
+def landau_integrals(v, table):
+    """Distribution function and first moment of the standard Landau distribution at v and
+    their derivatives, interpolated in the table. Above the table the density falls like 1/v^2.
+
+    :return: distribution function, its derivative, first moment, its derivative
+    """
+    position = (v - TABLE_START) / TABLE_STEP
+    if position <= 0.:
+        return 0., 0., 0., 0.
+    i = int(position)
+    if i >= table.shape[1] - 1:
+        end = TABLE_START + (table.shape[1] - 1) * TABLE_STEP
+        tail = table[2, -1] * end * end
+        return table[0, -1] + tail * (1. / end - 1. / v), tail / (v * v), \
+            table[1, -1] + tail * np.log(v / end), tail / v
+    t = position - i
+    v0 = TABLE_START + i * TABLE_STEP
+    cdf, density = _hermite(table[0, i], table[0, i + 1], table[2, i] * TABLE_STEP,
+                            table[2, i + 1] * TABLE_STEP, t)
+    moment, moment_density = _hermite(table[1, i], table[1, i + 1], v0 * table[2, i] * TABLE_STEP,
+                                      (v0 + TABLE_STEP) * table[2, i + 1] * TABLE_STEP, t)
+    return cdf, density, moment, moment_density
+
+
+@njit(cache=True)
+def langau_pdf(x, mu, eta, sigma, table, steps=100):
+    """Landau density (location mu, width eta) convolved with a Gaussian density at x
+    and its derivative in x. The range of +-5 sigma is split into cells, in every cell
+    the Gaussian is linearized and integrated with the probability and the first moment
+    of the Landau in the cell, so a Landau narrower than a cell needs no finer steps.
+
+    :return: density, derivative
+    """
+    step = 10. * sigma / steps
+    value = 0.
+    slope = 0.
+    low, dlow, mlow, dmlow = landau_integrals((x - 5. * sigma - mu) / eta, table)
+    for i in range(steps):
+        upp, dupp, mupp, dmupp = landau_integrals((x - 5. * sigma + (i + 1) * step - mu) / eta, table)
+        # Distance of the cell center to x and the Gaussian (derivative) there
+        offset = 5. * sigma - (i + 0.5) * step
+        gauss = INV_SQRT_2PI / sigma * np.exp(-0.5 * (offset / sigma) ** 2)
+        gauss_slope = -gauss * offset / sigma ** 2
+        # Probability and first moment (relative to the cell center) of the Landau in the cell
+        mass = upp - low
+        center = x - offset
+        moment = (mu - center) * mass + eta * (mupp - mlow)
+        value += gauss * mass - gauss_slope * moment
+        # Derivatives in x, the cells move with x
+        dmass = (dupp - dlow) / eta
+        dmoment = (mu - center) * dmass - mass + (dmupp - dmlow)
+        slope += gauss * dmass - gauss_slope * dmoment
+        low, dlow, mlow, dmlow = upp, dupp, mupp, dmupp
+    return value, slope
+
+
+@njit(cache=True)
+def langau_peak(eta, sigma, table):
+    """Position and height of the maximum of langau_pdf with mu = 0. The maximum is
+    searched on a coarse grid first, then the root of the derivative is bisected.
+
+    :return: position, height
+    """
+    low = -eta - 3. * sigma
+    spacing = (6. * eta + 8. * sigma) / 64
+    best = 0
+    best_value = -1.
+    for i in range(65):
+        value = langau_pdf(low + i * spacing, 0., eta, sigma, table)[0]
+        if value > best_value:
+            best, best_value = i, value
+
+    a = low + (best - 1) * spacing
+    b = low + (best + 1) * spacing
+    for _ in range(100):
+        if b - a < 1e-12 * (eta + sigma):
+            break
+        center = 0.5 * (a + b)
+        if langau_pdf(center, 0., eta, sigma, table)[1] > 0:
+            a = center
+        else:
+            b = center
+    peak = 0.5 * (a + b)
+    return peak, langau_pdf(peak, 0., eta, sigma, table)[0]
+
+
+@njit(cache=True)
+def _langau(x, mpv, eta, sigma, A, table):
+    """Model values and derivatives in x, see langau"""
+    peak, height = langau_peak(eta, sigma, table)
+    values = np.empty(len(x))
+    slopes = np.empty(len(x))
+    for i in range(len(x)):
+        value, slope = langau_pdf(x[i] - mpv + peak, 0., eta, sigma, table)
+        values[i] = A / height * value
+        slopes[i] = A / height * slope
+    return values, slopes
+
+
+@njit(cache=True)
+def _langau_jacobian(x, mpv, eta, sigma, A, table):
+    """See langau_jacobian"""
+    values, slopes = _langau(x, mpv, eta, sigma, A, table)
+    jac = np.empty((len(x), 4))
+    jac[:, 0] = -slopes
+    deta = 1e-5 * eta
+    jac[:, 1] = (_langau(x, mpv, eta + deta, sigma, A, table)[0] -
+                 _langau(x, mpv, eta - deta, sigma, A, table)[0]) / (2 * deta)
+    dsigma = 1e-5 * sigma
+    jac[:, 2] = (_langau(x, mpv, eta, sigma + dsigma, A, table)[0] -
+                 _langau(x, mpv, eta, sigma - dsigma, A, table)[0]) / (2 * dsigma)
+    jac[:, 3] = values / A
+    return jac
+
+
+def langau(x, mpv, eta, sigma, A):
+    """Landau-Gauss function with its maximum A at mpv, like pylandau.langau
+
+    :param x: array of positions
+    :param mpv: most probable value
+    :param eta: width of the Landau
+    :param sigma: width of the Gaussian
+    :param A: height of the maximum
+    """
+    return _langau(np.asarray(x, dtype=np.float64), mpv, eta, sigma, A, get_landau_table())[0]
+
+
+def langau_jacobian(x, mpv, eta, sigma, A):
+    """Derivatives of langau in mpv, eta, sigma and A (columns). The ones in mpv and A
+    are analytic, the ones in eta and sigma are central differences."""
+    return _langau_jacobian(np.asarray(x, dtype=np.float64), mpv, eta, sigma, A, get_landau_table())
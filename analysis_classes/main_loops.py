@@ -3,9 +3,70 @@ run data"""
 #pylint: disable=R0902,R0915,C0103
 
 from multiprocessing import Pool
+from time import time
 
 from analysis_classes.BaseAnalysis import *
 from analysis_classes.utilities import *  # import_h5, Bdata, read_binary_Alibava
+from analysis_classes.result_cache import ResultCache
+from analysis_classes.run_index import RunIndex, series_settings
+
+
+class FileAnalysisSettings:
+    """The settings of MainLoops which the event analysis of a file needs. Unlike
+    MainLoops it holds neither the pool nor the loaded files, so it can be sent
+    to worker processes. The counters start at 0 for every file."""
+
+    attributes = ["numchan", "pedestal", "noise", "noisy_strips", "CMN", "CMsig", "SN_cut", "SN_ratio",
+                  "SN_cluster", "max_clustersize", "masking", "material", "usejit", "parallel_clustering",
+                  "tmin", "chunk_size", "single_event", "isBinary", "lazy"]
+
+    def __init__(self, main):
+        for name in self.attributes:
+            setattr(self, name, getattr(main, name))
+        self.numgoodevents = 0
+        self.automasked_hit = 0
+        self.process_pool = 1  # Workers of a pool can not start a pool themselves
+        self.Pool = None
+
+
+def analyse_file(path, settings):
+    """Opens a measurement file and does the event analysis of it, this is the
+    worker of the file level parallelism. Every worker opens its own file handle.
+
+    :param path: path of the measurement file
+    :param settings: FileAnalysisSettings
+    :return: EventStore (EventAccumulator in streaming mode), good events, automasked hits
+    """
+    if not settings.isBinary:
+        datafile = import_h5(path)[0]
+    else:
+        datafile = read_binary_Alibava(path, lazy=settings.lazy)
+
+    if settings.chunk_size:
+        result = stream_file(settings, datafile)
+    else:
+        events = np.array(datafile["events"]["signal"][:], dtype=np.float32)
+        timing = np.array(datafile["events"]["time"][:], dtype=np.float32)
+        result = BaseAnalysis(settings, events, timing).run()
+    return result, settings.numgoodevents, settings.automasked_hit
+
+
+def stream_file(main, datafile):
+    """Processes a file chunk by chunk and folds the results into an
+    EventAccumulator. Only one chunk of raw and processed events is in
+    memory at a time.
+
+    :param main: MainLoops or FileAnalysisSettings
+    :param datafile: loaded data file (h5py file or binary dict)
+    :return: EventAccumulator
+    """
+    accumulator = EventAccumulator(main.numchan, keep_events=[main.single_event])
+    for _, events, timing in tqdm(iter_event_chunks(datafile["events"], main.chunk_size),
+                                      desc="Chunks processed:",
+                                      total=int(np.ceil(len(datafile["events"]["signal"]) / main.chunk_size))):
+        results = BaseAnalysis(main, events, timing).run()
+        accumulator.add(results)
+    return accumulator
 
 
 class MainLoops:
@@ -24,6 +85,26 @@ class MainLoops:
         # Init parameters
         self.log = logging.getLogger()
 
+        # CCE series mode: runs with a valid entry in the run index are not analysed again
+        self.run_index = None
+        self.series = path_list
+        if path_list and "CCE" in (kwargs["configs"].get("additional_analysis") or []) and \
+                (kwargs["configs"].get("CCE") or {}).get("index", ""):
+            cce_config = kwargs["configs"]["CCE"]
+            self.run_index = RunIndex(cce_config["index"], cce_config.get("pattern"))
+            self.series_settings = series_settings(kwargs["configs"], kwargs["configs"]["noise_analysis"],
+                                                   kwargs["configs"].get("calibration", None))
+            path_list = self.run_index.outdated(path_list, self.series_settings)
+            self.log.info("{!s} of {!s} runs of the series are new or changed".format(len(path_list),
+                                                                                       len(self.series)))
+            if not path_list:
+                # Nothing to analyse, the CCE is made from the index alone
+                self.outputdata = {}
+                self.pathes = self.file_keys = []
+                self.kwargs = kwargs
+                load_plugins(["CCE"])["CCE"](self).plot()
+                return
+
         if not path_list:
             self.log.info("No file to analyse passed...")
             self.outputdata = {}
@@ -31,12 +112,20 @@ class MainLoops:
 
         self.log.info("Loading event file(s): {!s}".format(path_list))
 
-        if not kwargs["configs"].get("isBinary", False):
+        # Streaming mode: events are processed in chunks of this size, 0 processes whole files at once
+        self.chunk_size = kwargs["configs"].get("chunk_size", 0)
+        # Whole files are processed in parallel by the workers of the pool
+        self.parallel_files = kwargs["configs"].get("parallel_files", False) and len(path_list) > 1
+
+        self.isBinary = kwargs["configs"].get("isBinary", False)
+        self.lazy = kwargs["configs"].get("memmap_binary", False) or bool(self.chunk_size)
+        if not self.isBinary:
             self.data = import_h5(path_list)
         else:
             self.data = []
             for path in path_list:
-                self.data.append(read_binary_Alibava(path))
+                # The workers open the files themselves, here only the header is needed
+                self.data.append(read_binary_Alibava(path, lazy=self.lazy or self.parallel_files))
 
         self.numchan = len(self.data[0]["events"]["signal"][0])
         self.numevents = len(self.data[0]["events"]["signal"])
@@ -56,6 +145,7 @@ class MainLoops:
         self.additional_analysis = []
         self.start = time()
         self.pathes = path_list
+        self.file_keys = []  # Keys of the files in outputdata, in the order of pathes
         self.kwargs = kwargs
         self.noise_analysis = kwargs["configs"].get("noise_analysis", None)
         self.calibration = kwargs["configs"].get("calibration", None)
@@ -66,6 +156,7 @@ class MainLoops:
         self.CMN = self.noise_analysis.CMnoise
         self.CMsig = self.noise_analysis.CMsig
         self.noise = self.noise_analysis.noise
+        self.noisy_strips = self.noise_analysis.noisy_strips
         self.SN_cut = self.kwargs["configs"]["SN_cut"]  # Cut for the signal to noise ratio
 
         # For additional analysis
@@ -85,6 +176,17 @@ class MainLoops:
         self.SN_ratio = kwargs["configs"].get("SN_ratio", 0.5)
         self.usejit = kwargs["configs"].get("optimize", False)
         self.SN_cluster = kwargs["configs"].get("SN_cluster", 6)
+        self.parallel_clustering = kwargs["configs"].get("parallel_clustering", False)  # prange clustering kernel
+
+        # Stage cache: results of the CM/SN, clustering and plugin stages are stored per input fingerprint
+        self.cache = None
+        if kwargs["configs"].get("Cache_folder", ""):
+            self.cache = ResultCache(kwargs["configs"]["Cache_folder"])
+        self.stage_keys = []  # Keys of the clustering stage of all files
+        if self.parallel_files and self.cache is not None:
+            self.log.warning("Files are not processed in parallel when the stage cache (Cache_folder) is used")
+            self.parallel_files = False
+        self.single_event = kwargs["configs"].get("Plot_single_event", 15)
 
         # Create a pool for multiprocessing
         self.process_pool = kwargs["configs"].get("Processes", 1)  # How many workers
@@ -95,38 +197,87 @@ class MainLoops:
             self.max = kwargs["configs"]["timing"][1]  # timing maximum
 
         self.log.info("Processing files ...")
+        file_results = self.analyse_files_parallel(path_list) if self.parallel_files else []
         # Here a loop over all files will be done to do the analysis on all imported files
         for data in tqdm(range(len(self.data)), desc="Data files processed:"):
-            events = np.array(self.data[data]["events"]["signal"][:], dtype=np.float32)
-            timing = np.array(self.data[data]["events"]["time"][:], dtype=np.float32)
-
             try:
                 file = str(self.data[data]).split('"')[1].split('.')[0]
             except:
                 file = str(data)
             self.outputdata[file] = {}
+            self.file_keys.append(file)
+
+            if file_results:
+                self.outputdata[file]["base"] = file_results[data]
+                continue
+
+            if self.chunk_size:
+                self.outputdata[file]["base"] = stream_file(self, self.data[data])
+                continue
+
+            if self.cache is not None:
+                self.outputdata[file]["base"] = self.cached_file_analysis(path_list[data], self.data[data])
+                continue
+
+            events = np.array(self.data[data]["events"]["signal"][:], dtype=np.float32)
+            timing = np.array(self.data[data]["events"]["time"][:], dtype=np.float32)
             # Todo: Make this loop work in a pool of processes/threads whichever is easier and better
-            object = BaseAnalysis(self, events,
-                                   timing)  # you get back a list with events, containing the event processed data -->
-                                            # np array makes it easier to slice
-            results = object.run()
+            if not data and self.usejit and kwargs["configs"].get("measure_speedup", []):
+                # Report the speedup of the parallel event processing for the passed worker counts,
+                # measured on the first file only (its events are processed once per worker count)
+                self.log.info("Measuring the parallel speedup on the first file: {!s}".format(path_list[data]))
+                from analysis_classes.nb_analysis import measure_parallel_speedup
+                measure_parallel_speedup(events, kwargs["configs"]["measure_speedup"],
+                                         pedestal=self.pedestal, meanCMN=np.mean(self.CMN),
+                                         meanCMsig=np.mean(self.CMsig), noise=self.noise, numchan=self.numchan,
+                                         SN_cut=self.SN_cut, SN_ratio=self.SN_ratio, SN_cluster=self.SN_cluster,
+                                         max_clustersize=self.max_clustersize, masking=self.masking,
+                                         material=self.material, noisy_strips=self.noisy_strips,
+                                         parallel=self.parallel_clustering)
+
+            base = BaseAnalysis(self, events, timing)
+            self.outputdata[file]["base"] = base.run()  # EventStore with Bdata like label access
 
-            self.outputdata[file]["base"] = Bdata(results,
-                                                  labels=["Signal", "SN", "CMN", "CMsig", "Hitmap", "Channel_hit",
-                                                          "Clusters", "Numclus", "Clustersize"])
+        # The plots are made from the outputdata of all files, not from the events of one analysis
+        base = BaseAnalysis(self, None, None)
+        base.plot_data(single_event=self.single_event)  # Not very pythonic, loop inside analysis (legacy)
 
-        object.plot_data(single_event=kwargs["configs"].get("Plot_single_event",
-                                                            15))  # Not very pythonic, loop inside analysis (legacy)
+        # Scan of the clustering cuts on the already common mode corrected events
+        if kwargs["configs"].get("cut_scan", {}):
+            if self.chunk_size:
+                self.log.warning("The cut scan needs the signal of every event, which is not kept in "
+                                 "streaming mode (chunk_size). Skipping the cut scan")
+            else:
+                self.run_cut_scan(kwargs["configs"]["cut_scan"])
         # Now process additional analysis statet in the config file
 
-        # Load all plugins
-        plugins = load_plugins()
+        # Load only the plugins which are used
+        plugins = load_plugins(self.add_analysis)
+        if self.chunk_size:
+            # Only analysis which can work with the accumulated data of the streaming mode can run
+            skipped = [analysis for analysis in self.add_analysis
+                       if not getattr(plugins[analysis], "streaming", False)]
+            if skipped:
+                self.log.warning("Additional analysis need the data of every event, which is not kept in "
+                                 "streaming mode (chunk_size). Skipping: {!s}".format(skipped))
+                self.add_analysis = [analysis for analysis in self.add_analysis if analysis not in skipped]
 
+        plugin_keys = {}
         for analysis in self.add_analysis:
             self.log.info("Starting analysis: {!s}".format(analysis))
             # Gets the total analysis class, so be aware of changes inside!!!
-            add_analysis = getattr(plugins[analysis], str(analysis))(self)
-            results = add_analysis.run()
+            add_analysis = plugins[analysis](self)
+            results = None
+            if self.cache is not None:
+                # A plugin depends on the clustering of all files, its config and the plugins it uses
+                plugin_keys[analysis] = self.plugin_key(analysis, add_analysis, plugin_keys)
+                results = self.cache.load_object(plugin_keys[analysis])
+                if results is not None:
+                    add_analysis.results_dict = results  # The plots are made from the results dict
+            if results is None:
+                results = add_analysis.run()
+                if self.cache is not None:
+                    self.cache.save_object(plugin_keys[analysis], results)
             add_analysis.plot()
             if results:  # Only if results have been returned
                 for file in results:
@@ -155,3 +306,89 @@ class MainLoops:
         self.Pool.close()
         self.Pool.join()
 
+    def cached_file_analysis(self, path, datafile):
+        """Processes a file in stages (CM/SN, clustering), every stage is loaded from
+        the cache if the stage and its inputs did not change. If only the cluster cuts
+        changed, only the clustering reruns.
+
+        :param path: path of the data file
+        :param datafile: loaded data file (h5py file or binary dict)
+        :return: EventStore
+        """
+        cm_key = self.cache.key([path], arrays=[self.pedestal, self.noise, self.noisy_strips,
+                                                [np.mean(self.CMN), np.mean(self.CMsig)]],
+                                stage="CM/SN", tmin=self.tmin, optimize=self.usejit)
+        cluster_key = self.cache.key([], stage="clustering", CM=cm_key, SN_cut=self.SN_cut, SN_ratio=self.SN_ratio,
+                                     SN_cluster=self.SN_cluster, max_cluster_size=self.max_clustersize,
+                                     automasking=self.masking, material=self.material, optimize=self.usejit)
+        self.stage_keys.append(cluster_key)
+
+        common_mode = self.cache.load(cm_key)
+        clusters = self.cache.load(cluster_key) if common_mode is not None else None
+        if clusters is not None:
+            self.numgoodevents += len(common_mode["CMN"])
+            self.automasked_hit += int(clusters["automasked"])
+            common_mode.update(clusters)
+            return EventStore.from_dict(common_mode, self.numchan)
+
+        if common_mode is not None:
+            self.log.info("Common mode correction unchanged, only clustering")
+            self.numgoodevents += len(common_mode["CMN"])
+            store = BaseAnalysis(self, None, None).cluster(common_mode["signal"], common_mode["SN"],
+                                                           common_mode["CMN"], common_mode["CMsig"])
+        else:
+            events = np.array(datafile["events"]["signal"][:], dtype=np.float32)
+            timing = np.array(datafile["events"]["time"][:], dtype=np.float32)
+            store = BaseAnalysis(self, events, timing).run()
+            self.cache.save(cm_key, store.to_dict(EventStore.common_mode_columns))
+        self.cache.save(cluster_key, store.to_dict(EventStore.cluster_columns))
+        return store
+
+    def run_cut_scan(self, grid):
+        """Clusters every file again for all combinations of the cut values in grid,
+        the table of every file is stored in outputdata[file]["cut_scan"]
+
+        :param grid: dict with a list of values for SN_cut, SN_ratio, SN_cluster and/or max_cluster_size
+        """
+        from analysis_classes.cut_scan import cut_scan
+        langau = self.kwargs["configs"].get("langau", {})
+        defaults = {"SN_cut": self.SN_cut, "SN_ratio": self.SN_ratio, "SN_cluster": self.SN_cluster,
+                    "max_cluster_size": self.max_clustersize}
+        for file, data in self.outputdata.items():
+            self.log.info("Cut scan of file: {!s}".format(file))
+            data["cut_scan"] = cut_scan(data["base"], self.noise, grid, defaults, masking=self.masking,
+                                        material=self.material, usejit=self.usejit,
+                                        charge_coeff=getattr(self.calibration, "meancoeff", None),
+                                        numClus=langau.get("numClus", [1]),
+                                        Ecut=langau.get("energyCutOff", 150000), bins=langau.get("bins", 500),
+                                        Pool=self.Pool if self.process_pool > 1 else None)
+
+    def plugin_key(self, analysis, plugin, plugin_keys):
+        """Cache key of the results of an analysis plugin. Plugins list the config keys
+        they depend on in config_keys (default is the config section of the plugin) and
+        the plugins whose results they use in depends_on (default all plugins before)."""
+        configs = self.kwargs["configs"]
+        calibration = []
+        if self.calibration is not None and self.calibration.meancoeff is not None:
+            calibration = [self.calibration.meancoeff, self.calibration.strip_coeff]
+        previous = {name: key for name, key in plugin_keys.items()
+                    if name in getattr(plugin, "depends_on", plugin_keys)}
+        return self.cache.key([], arrays=calibration, stage=analysis, previous=previous,
+                              clustering=self.stage_keys, lut_step=getattr(self.calibration, "lut_step", 0.),
+                              configs={key: configs.get(key) for key in
+                                       getattr(plugin, "config_keys", [analysis.lower()])})
+
+    def analyse_files_parallel(self, path_list):
+        """Does the event analysis of all files at once, one file per worker of the pool.
+        The workers open the files themselves and send back the columnar results.
+
+        :param path_list: paths of the measurement files
+        :return: list with the EventStore (EventAccumulator in streaming mode) of every file
+        """
+        self.log.info("Processing {!s} files with {!s} workers".format(len(path_list), self.process_pool))
+        settings = FileAnalysisSettings(self)
+        results = self.Pool.starmap(analyse_file, [(path, settings) for path in path_list], chunksize=1)
+        for _, numgoodevents, automasked_hit in results:
+            self.numgoodevents += numgoodevents
+            self.automasked_hit += automasked_hit
+        return [result for result, _, _ in results]
@@ -1,89 +1,112 @@
 # This files contains analysis function optimizes by numba jit capabilities
 
-from numba import jit
-from multiprocessing import Manager
+import logging
+import os
+import types
+from multiprocessing import Pool as ProcessPool
+from time import time
+from numba import jit, njit, prange
 from analysis_classes.utilities import *
+from analysis_classes.event_store import EventStore
+from analysis_classes.shared_arrays import SharedArrays
 import numpy as np
-from tqdm import tqdm
 
 def event_process_function(start, end, events, pedestal, meanCMN, meanCMsig, noise,
                            numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize,
-                           masking, material, noisy_strips, queue=None):
-    """Necessary function to pass to the pool.map function"""
-    prodata = np.zeros((np.abs(start-end), 9), dtype=np.object)
-    #automasked = 0
-    index = 0
-    hitmap = np.zeros(numchan)
+                           masking, material, noisy_strips, parallel=False):
+    """Necessary function to pass to the pool.map function, returns an EventStore"""
     signal, SN, CMN, CMsig = nb_process_all_events(start, end, events, pedestal, meanCMN,
                                                    meanCMsig, noise, numchan, noisy_strips)
-    for i in tqdm(range(0, abs(start-end)), desc="Events processed"):
-        channels_hit, clusters, numclus, clustersize, automasked_hits = nb_clustering(signal[i], SN[i], noise, SN_cut,
-                                                                                      SN_ratio, SN_cluster, numchan,
-                                                                                      max_clustersize=max_clustersize,
-                                                                                      masking=masking,
-                                                                                      material=material)
-        for channel in channels_hit:
-            hitmap[channel] += 1
-
-        prodata[index]=np.array([
-            signal[i],
-            SN[i],
-            CMN,
-            CMsig,
-            hitmap, # Todo: remove hitmap from every event Is useless info and costs memory
-            channels_hit,
-            clusters,
-            numclus,
-            clustersize])
-        index +=1
-    return prodata
+    hit_channels, hit_offsets, clus_event, clus_first, clus_size, _, _, automasked = \
+        cluster_all_events(signal, SN, noise, SN_cut, SN_ratio, SN_cluster, max_clustersize,
+                           masking, material, parallel=parallel)
+
+    return EventStore.from_clusters(signal, SN, CMN, CMsig, hit_channels, hit_offsets,
+                                    clus_event, clus_first, clus_size, numchan, automasked)
+
+def shared_event_process_function(shared, start, end, *params):
+    """Worker function of the parallel processing. Processes the events start:end of the
+    shared event matrix and writes signal and SN into the shared output matrices, so only
+    the small columns of the EventStore are sent back"""
+    store = event_process_function(start, end, shared["events"], *params)
+    shared["signal"][start:end] = store.signal
+    shared["SN"][start:end] = store.SN
+    store.signal, store.SN = None, None
+    return store
 
 def parallel_event_processing(goodtiming, events, pedestal, meanCMN, meanCMsig, noise,
                               numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize = 5,
-                              masking=True, material=1, poolsize = 1, Pool=None, noisy_strips = []):
-    """Parallel processing of events."""
+                              masking=True, material=1, poolsize = 1, Pool=None, noisy_strips = [],
+                              parallel=False):
+    """Parallel processing of events.
+    The good events are put into shared memory (SharedArrays) once. Every worker only gets
+    an index range, the ranges cover every event exactly once. Signal and SN are written by
+    the workers into shared output matrices, which become the columns of the merged EventStore.
+    Without the space for the shared matrices the events are processed in this process."""
     goodevents = goodtiming[0].shape[0]
-    automasked = 0
+    params = (pedestal, meanCMN, meanCMsig, noise, numchan, SN_cut, SN_ratio, SN_cluster,
+              max_clustersize, masking, material, noisy_strips, parallel)
 
     if poolsize > 1:
+        # Events, signal and SN are shared
+        nbytes = goodevents * numchan * (np.dtype(getattr(events, "dtype", np.float32)).itemsize + 8)
+        try:
+            shared = SharedArrays(nbytes)
+        except OSError as err:
+            logging.getLogger().warning("{!s}, the events are processed in this process".format(err))
+            poolsize = 1
 
-        manager = Manager()
-        q = manager.Queue()
-        # Split data for the pools
-        splits = int(goodevents/poolsize) # you may loose the last event!!!
-        paramslist = []
-        start = 0
-        results = []
-        for i in range(poolsize):
-            end = splits*(i+1)
-            paramslist.append((start, end, events[goodtiming[0]], pedestal, meanCMN, meanCMsig,
-                               noise, numchan, SN_cut, SN_ratio, SN_cluster, max_clustersize,
-                               masking, material, noisy_strips, q))
-            start=end+1
-
-        results = Pool.starmap(event_process_function, paramslist, chunksize=1)
-        #for i in paramslist:
-        #    results.append(event_process_function(*i))
-        #prodata = np.zeros((goodevents, 9), dtype=np.object)
-        #for i in tqdm(range(len(goodevents))):
-        #    prodata[i] = q.get()
-
-
-
-        # Build the correct Hitmap which gets lost during calculations
-        hitmap = np.zeros(numchan)
-        for hmap in results:
-            hitmap += hmap[-1][4]
-        prodata = np.concatenate(results, axis=0)
-        # Set the last hit with the full hitmap # I know this is pretty shitty coding style.
-        prodata[-1][4] = hitmap
-        return prodata, automasked
+    if poolsize > 1:
+        with shared:
+            shared.share("events", events, indices=goodtiming[0])
+            shared.create("signal", (goodevents, numchan), np.float32)
+            shared.create("SN", (goodevents, numchan), np.float32)
+
+            # Split data for the pools
+            bounds = np.linspace(0, goodevents, poolsize + 1).astype(np.int64)
+            paramslist = [(shared, start, end) + params for start, end in zip(bounds[:-1], bounds[1:])]
+            results = Pool.starmap(shared_event_process_function, paramslist, chunksize=1)
+
+            signal, SN = shared["signal"], shared["SN"]
+            if os.name != "posix":  # Mapped files can not be removed on windows
+                signal, SN = np.array(signal), np.array(SN)
+
+        prodata = EventStore.concatenate(results)
+        prodata.signal, prodata.SN = np.asarray(signal), np.asarray(SN)
+        return prodata, prodata.automasked
 
     else:
-        prodata = event_process_function(0, goodevents, events[goodtiming[0]], pedestal, meanCMN,
-                                         meanCMsig, noise, numchan, SN_cut, SN_ratio, SN_cluster,
-                                         max_clustersize, masking, material, noisy_strips)
-        return np.array(prodata), automasked
+        prodata = event_process_function(0, goodevents, events[goodtiming[0]], *params)
+        return prodata, prodata.automasked
+
+def measure_parallel_speedup(events, worker_counts, **kwargs):
+    """Processes the same events with different numbers of workers and reports the
+    measured speedup with respect to the first worker count. MainLoops measures it on
+    the events of the first file only (config measure_speedup).
+
+    :param events: raw events (events, channels)
+    :param worker_counts: list of the numbers of workers to test, e.g. [1, 2, 4, 8]
+    :param kwargs: the parameters of parallel_event_processing, except poolsize and Pool
+    :return: list of (workers, seconds, speedup)
+    """
+    log = logging.getLogger()
+    goodtiming = (np.arange(len(events)),)
+    report = []
+    # Warm up, so that the compilation of the kernels is not measured
+    parallel_event_processing((goodtiming[0][:10],), events, poolsize=1, Pool=None, **kwargs)
+    for workers in worker_counts:
+        pool = ProcessPool(processes=workers)
+        start = time()
+        parallel_event_processing(goodtiming, events, poolsize=workers, Pool=pool, **kwargs)
+        report.append([workers, time() - start])
+        pool.close()
+        pool.join()
+
+    log.info("Parallel event processing of {!s} events:".format(len(events)))
+    for entry in report:
+        entry.append(report[0][1] / entry[1])
+        log.info("    workers: {:>3d}   time: {:8.3f} s   speedup: {:5.2f}".format(*entry))
+    return [tuple(entry) for entry in report]
 
 @jit(nopython = True, cache=True)
 def nb_clustering(event, SN, noise, SN_cut, SN_ratio, SN_cluster, numchan, max_clustersize = 5,
@@ -164,6 +187,179 @@ def nb_clustering(event, SN, noise, SN_cut, SN_ratio, SN_cluster, numchan, max_c
 
     return channels, clusters_list, numclus, np.array(clustersize), automasked_hit
 
+def cluster_all_events(signal, SN, noise, SN_cut, SN_ratio, SN_cluster, max_clustersize=5,
+                       masking=True, material=1, parallel=False):
+    """Clusters all events with one call of the batch kernel.
+
+    :param signal: common mode corrected signal (events, channels)
+    :param SN: signal to noise (events, channels)
+    :param parallel: if True, the events are distributed over all cores (prange)
+    :return: hit_channels, hit_offsets (CSR of the channels above SN_cut), and per cluster
+             event id, first strip, size, charge (ADC), SN, followed by the number of automasked hits
+    """
+    kernel = nb_cluster_all_events_parallel if parallel else nb_cluster_all_events
+    return kernel(np.ascontiguousarray(signal, dtype=np.float32),
+                  np.ascontiguousarray(SN, dtype=np.float32),
+                  np.ascontiguousarray(noise, dtype=np.float32),
+                  float(SN_cut), float(SN_ratio), float(SN_cluster), int(max_clustersize),
+                  bool(masking), int(material))
+
+@njit(cache=True)
+def nb_cluster_event(event, SN, noise, SN_cut, SN_ratio, SN_cluster, max_clustersize, masking, material,
+                     hit_channels, clus_first, clus_size, clus_charge, clus_SN, start):
+    """Clusters a single event like nb_clustering, but writes hits and clusters into the
+    flat output arrays beginning at index start. Returns the number of hits, clusters and automasked hits"""
+    numchan = len(event)
+    SNval = SN_cut * SN_ratio
+    offset = int(max_clustersize * 0.5)
+    used_channels = np.ones(numchan, dtype=np.bool_)
+    automasked_hit = 0
+    numhits = 0
+    for ch in range(numchan):
+        if not masking or (material and event[ch] < 0) or (not material and event[ch] > 0):
+            used_channels[ch] = False
+        if abs(SN[ch]) > SN_cut:
+            hit_channels[start + numhits] = ch
+            numhits += 1
+            if masking and ((material and event[ch] > 0) or (not material and event[ch] < 0)):
+                automasked_hit += 1
+
+    numclus = 0
+    for k in range(numhits):
+        ch = hit_channels[start + k]
+        if used_channels[ch]:
+            continue
+        used_channels[ch] = True
+        left = ch
+        right = ch
+        right_stop = False
+        left_stop = False
+        for i in range(1, offset + 1):
+            if 0 < ch - i and ch + i < numchan:  # To exclude overrun
+                if not right_stop:
+                    if abs(SN[ch + i]) > SNval and not used_channels[ch + i]:
+                        used_channels[ch + i] = True
+                        right = ch + i
+                    else:
+                        right_stop = True
+                if not left_stop:
+                    if abs(SN[ch - i]) > SNval and not used_channels[ch - i]:
+                        used_channels[ch - i] = True
+                        left = ch - i
+                    else:
+                        left_stop = True
+
+        # Look if the cluster SN is big enough to be counted as clusters
+        Scluster = 0.
+        Ncluster = 0.
+        for strip in range(left, right + 1):
+            Scluster += event[strip]
+            Ncluster += noise[strip]
+        Scluster = abs(Scluster)
+        Ncluster = np.sqrt(abs(Ncluster))
+        if Scluster / Ncluster > SN_cluster:
+            clus_first[start + numclus] = left
+            clus_size[start + numclus] = right - left + 1
+            clus_charge[start + numclus] = Scluster
+            clus_SN[start + numclus] = Scluster / Ncluster
+            numclus += 1
+
+    return numhits, numclus, automasked_hit
+
+def _flavour(func, suffix):
+    """Copy of a kernel function under an other name. Numba names the cache files after the
+    function, without the copy the serial and the prange kernel of a function would load
+    each others compilation from the cache"""
+    flavour = types.FunctionType(func.__code__, func.__globals__, func.__name__ + suffix,
+                                 func.__defaults__, func.__closure__)
+    flavour.__qualname__ = func.__qualname__ + suffix
+    flavour.__doc__ = func.__doc__
+    return flavour
+
+def _cluster_all_events(signal, SN, noise, SN_cut, SN_ratio, SN_cluster, max_clustersize, masking, material):
+    """Batch clustering kernel, see cluster_all_events. Every event gets a slot in the output
+    arrays as large as its number of hits (each cluster has a seed above SN_cut), so events
+    can be processed independently and are compacted afterwards."""
+    numevents, numchan = SN.shape
+    slots = np.zeros(numevents + 1, dtype=np.int64)
+    for ev in prange(numevents):
+        count = 0
+        for ch in range(numchan):
+            if abs(SN[ev, ch]) > SN_cut:
+                count += 1
+        slots[ev + 1] = count
+    slots = np.cumsum(slots)
+
+    hit_channels = np.empty(slots[-1], dtype=np.int32)
+    clus_first = np.empty(slots[-1], dtype=np.int32)
+    clus_size = np.empty(slots[-1], dtype=np.int32)
+    clus_charge = np.empty(slots[-1], dtype=np.float32)
+    clus_SN = np.empty(slots[-1], dtype=np.float32)
+    numclus = np.zeros(numevents + 1, dtype=np.int64)
+    automasked = np.zeros(numevents, dtype=np.int64)
+    for ev in prange(numevents):
+        _, nclus, masked = nb_cluster_event(signal[ev], SN[ev], noise, SN_cut, SN_ratio, SN_cluster,
+                                            max_clustersize, masking, material, hit_channels,
+                                            clus_first, clus_size, clus_charge, clus_SN, slots[ev])
+        numclus[ev + 1] = nclus
+        automasked[ev] = masked
+
+    # Compact the cluster slots
+    clus_offsets = np.cumsum(numclus)
+    clus_event = np.empty(clus_offsets[-1], dtype=np.int64)
+    for ev in range(numevents):
+        for k in range(numclus[ev + 1]):
+            dest = clus_offsets[ev] + k
+            clus_event[dest] = ev
+            clus_first[dest] = clus_first[slots[ev] + k]
+            clus_size[dest] = clus_size[slots[ev] + k]
+            clus_charge[dest] = clus_charge[slots[ev] + k]
+            clus_SN[dest] = clus_SN[slots[ev] + k]
+    total = clus_offsets[-1]
+
+    return (hit_channels, slots, clus_event, clus_first[:total].copy(), clus_size[:total].copy(),
+            clus_charge[:total].copy(), clus_SN[:total].copy(), automasked.sum())
+
+nb_cluster_all_events = njit(cache=True)(_cluster_all_events)
+nb_cluster_all_events_parallel = njit(cache=True, parallel=True)(_flavour(_cluster_all_events, "_parallel"))
+
+def cluster_centres(member_charge, member_signal, cluster_members, cluster_offsets, parallel=False):
+    """Centre of gravity and highest strip of every cluster with one call of the kernel.
+
+    :param member_charge: charge of every strip of the flat cluster table (cluster_members)
+    :param member_signal: absolute signal of every strip of the cluster table, the highest
+                          strip is the first strip with the largest one
+    :param parallel: if True, the clusters are distributed over all cores (prange)
+    :return: per cluster centre of gravity (nan without charge) and highest strip
+    """
+    kernel = nb_cluster_centres_parallel if parallel else nb_cluster_centres
+    return kernel(np.ascontiguousarray(member_charge, dtype=np.float64),
+                  np.ascontiguousarray(member_signal, dtype=np.float32),
+                  np.ascontiguousarray(cluster_members, dtype=np.int32),
+                  np.ascontiguousarray(cluster_offsets, dtype=np.int64))
+
+def _cluster_centres(member_charge, member_signal, cluster_members, cluster_offsets):
+    """Centre of gravity kernel, see cluster_centres"""
+    numclus = len(cluster_offsets) - 1
+    cog = np.empty(numclus)
+    highest = np.empty(numclus, dtype=np.int64)
+    for clus in prange(numclus):
+        weight = 0.
+        weighted = 0.
+        best = cluster_offsets[clus]
+        for k in range(cluster_offsets[clus], cluster_offsets[clus + 1]):
+            weight += member_charge[k]
+            weighted += member_charge[k] * cluster_members[k]
+            if member_signal[k] > member_signal[best]:
+                best = k
+        # The calibrated charges can sum up to 0 (offset of the calibration, opposite signs)
+        cog[clus] = weighted / weight if weight != 0. else np.nan
+        highest[clus] = cluster_members[best]
+    return cog, highest
+
+nb_cluster_centres = njit(cache=True)(_cluster_centres)
+nb_cluster_centres_parallel = njit(cache=True, parallel=True)(_flavour(_cluster_centres, "_parallel"))
+
 def nb_noise_calc(events, pedestal):
     """Noise calculation, normal noise (NN) and common mode noise (CMN)
     Uses numpy"""
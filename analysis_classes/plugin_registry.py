@@ -0,0 +1,69 @@
+"""This file contains the registry of the additional analysis (plugins). The plugins
+are found by reading the sources of the modules in this folder, so a plugin is only
+imported (together with matplotlib, scipy, numba...) if it is actually used"""
+# pylint: disable=C0103
+
+import ast
+import logging
+import os
+from importlib import import_module
+
+# A plugin is a class with these methods, see e.g. Langau
+PLUGIN_METHODS = {"run", "plot"}
+
+
+class PluginRegistry:
+    """Maps the names of the additional analysis (the class names, e.g. Langau) to
+    their modules without importing them:
+
+        registry = PluginRegistry()
+        registry.names()              # ["CCE", "ChargeSharing", "Langau"]
+        Langau = registry.load("Langau")
+
+    A name can also be given by its module (e.g. langau), as long as the module
+    contains only one plugin.
+    """
+
+    def __init__(self, folder=None, package="analysis_classes"):
+        # The folder of the package, not of the current working directory
+        self.folder = os.path.normpath(folder or os.path.dirname(os.path.abspath(__file__)))
+        self.package = package
+        self.log = logging.getLogger()
+        self.modules = {}  # plugin name -> module name
+        self.discover()
+
+    def discover(self):
+        """Searches the top level classes of all modules for plugins"""
+        for file in sorted(os.listdir(self.folder)):
+            module, extension = os.path.splitext(file)
+            if extension != ".py" or module.startswith("_"):
+                continue
+            try:
+                with open(os.path.join(self.folder, file), "rb") as source:
+                    tree = ast.parse(source.read(), filename=file)
+            except (OSError, SyntaxError, ValueError) as err:
+                self.log.warning("Could not read the module {!s} for plugins: {!s}".format(file, err))
+                continue
+            for node in tree.body:
+                if isinstance(node, ast.ClassDef):
+                    methods = {item.name for item in node.body if isinstance(item, ast.FunctionDef)}
+                    if PLUGIN_METHODS <= methods:
+                        self.modules[node.name] = module
+
+    def names(self):
+        """Names of all plugins"""
+        return sorted(self.modules)
+
+    def resolve(self, name):
+        """Name of the plugin class and its module of a plugin or module name"""
+        if name in self.modules:
+            return name, self.modules[name]
+        found = [plugin for plugin, module in self.modules.items() if module.lower() == str(name).lower()]
+        if len(found) == 1:
+            return found[0], self.modules[found[0]]
+        raise KeyError("No additional analysis {!s}, available are: {!s}".format(name, self.names()))
+
+    def load(self, name):
+        """Imports the module of a plugin and returns the plugin class"""
+        plugin, module = self.resolve(name)
+        return getattr(import_module(self.package + "." + module), plugin)
@@ -0,0 +1,116 @@
+"""This file contains a persistent cache for analysis results, which are
+addressed by the content of their input files and the parameters used"""
+# pylint: disable=C0103
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+import numpy as np
+
+
+class ResultCache:
+    """Stores results (dicts of numpy arrays) in npz files in a folder.
+
+    The key of a result is a hash over the content hashes of the input files and
+    the parameters. Hashing a file means reading it once, the content hash is
+    therefore remembered together with the path, size and mtime of the file, so
+    looking up an unchanged file only needs a stat call:
+
+        cache = ResultCache("cache")
+        key = cache.key(["pedestal.dat"], Noise_cut=5)
+        results = cache.load(key)
+        if results is None:
+            results = calculate()
+            cache.save(key, results)
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.normpath(directory)
+        self.log = logging.getLogger()
+        os.makedirs(self.directory, exist_ok=True)
+        self.index_path = os.path.join(self.directory, "file_hashes.json")
+        try:
+            with open(self.index_path) as index:
+                self.file_hashes = json.load(index)
+        except (OSError, ValueError):
+            self.file_hashes = {}
+
+    def file_hash(self, path):
+        """Content hash of a file, only recalculated if size or mtime changed"""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        entry = self.file_hashes.get(path)
+        if entry and entry["stamp"] == stamp:
+            return entry["hash"]
+
+        content = hashlib.sha1()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 22), b""):
+                content.update(block)
+        self.file_hashes[path] = {"stamp": stamp, "hash": content.hexdigest()}
+        with open(self.index_path, "w") as index:
+            json.dump(self.file_hashes, index)
+        return content.hexdigest()
+
+    def key(self, paths, arrays=(), **params):
+        """Key of a result
+
+        :param paths: input files
+        :param arrays: input arrays, hashed by content
+        :param params: parameters the result depends on (json serializable)
+        """
+        key = hashlib.sha1()
+        for path in paths:
+            key.update(self.file_hash(path).encode())
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            key.update(str((array.dtype, array.shape)).encode())
+            key.update(array.tobytes())
+        key.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return key.hexdigest()
+
+    def path(self, key, extension=".npz"):
+        """File of a result"""
+        return os.path.join(self.directory, key + extension)
+
+    def load(self, key):
+        """Returns the stored dict of arrays or None if there is no (valid) entry"""
+        try:
+            with np.load(self.path(key)) as data:
+                results = {name: data[name] for name in data.files}
+        except (OSError, ValueError) as err:
+            if os.path.exists(self.path(key)):
+                self.log.warning("Could not read cache entry {!s}: {!s}".format(key, err))
+            return None
+        self.log.info("Loaded cached results {!s}".format(key))
+        return results
+
+    def save(self, key, results):
+        """Stores a dict of arrays (or scalars). The file is written under a temporary
+        name first, so an interrupted write never leaves a broken entry."""
+        temp_path = self.path(key) + ".tmp.npz"
+        np.savez(temp_path, **results)
+        os.replace(temp_path, self.path(key))
+
+    def load_object(self, key):
+        """Returns a pickled result or None if there is no (valid) entry"""
+        try:
+            with open(self.path(key, ".pkl"), "rb") as file:
+                results = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError) as err:
+            if os.path.exists(self.path(key, ".pkl")):
+                self.log.warning("Could not read cache entry {!s}: {!s}".format(key, err))
+            return None
+        self.log.info("Loaded cached results {!s}".format(key))
+        return results
+
+    def save_object(self, key, results):
+        """Stores any picklable result, e.g. the nested results of an analysis plugin"""
+        temp_path = self.path(key, ".pkl.tmp")
+        with open(temp_path, "wb") as file:
+            pickle.dump(results, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.path(key, ".pkl"))
@@ -0,0 +1,138 @@
+"""This file contains a persistent index of the results of the runs of a measurement
+series (e.g. the bias voltage scan of a CCE measurement), so only runs which are new
+or changed have to be analysed when the series grows"""
+# pylint: disable=C0103
+
+import hashlib
+import json
+import logging
+import os
+import re
+
+import numpy as np
+
+# Bias voltage in a file or header, e.g. "run_-300V.dat" or "600 V"
+VOLTAGE_PATTERN = r"(-?\d+(?:\.\d+)?)\s*V(?![a-zA-Z])"
+
+# Config keys the results of a run depend on besides its file
+SERIES_CONFIG_KEYS = ["SN_cut", "SN_ratio", "SN_cluster", "max_cluster_size", "automasking", "sensor_type",
+                      "timing", "optimize", "langau"]
+
+
+def series_settings(configs, noise_analysis, calibration=None):
+    """Hash over everything the results of a run depend on except the run itself: the
+    pedestal run, the calibration and the analysis config
+
+    :param configs: config dict of the analysis
+    :param noise_analysis: NoiseAnalysis of the pedestal run
+    :param calibration: Calibration, if any
+    :return: hex digest
+    """
+    arrays = [noise_analysis.pedestal, noise_analysis.noise, noise_analysis.noisy_strips,
+              [np.mean(noise_analysis.CMnoise), np.mean(noise_analysis.CMsig)]]
+    if calibration is not None and calibration.meancoeff is not None:
+        arrays += [calibration.meancoeff, calibration.strip_coeff]
+    key = hashlib.sha1()
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        key.update(str((array.dtype, array.shape)).encode())
+        key.update(array.tobytes())
+    key.update(json.dumps({name: configs.get(name) for name in SERIES_CONFIG_KEYS},
+                          sort_keys=True, default=str).encode())
+    key.update(str(getattr(calibration, "lut_step", 0.)).encode())
+    return key.hexdigest()
+
+
+class RunIndex:
+    """Stores the results of every run of a series (MPV of the Langau fit and its errors)
+    together with metadata of the run (e.g. the bias voltage parsed from the file name)
+    in a json file. A run is identified by its path, its entry stays valid as long as
+    size and mtime of the file and the settings of the analysis are unchanged:
+
+        index = RunIndex("cce_index.json")
+        runs = index.outdated(paths, settings)
+        results = analyse(runs)
+        for path in runs:
+            index.update(path, settings, mpv=results[path])
+        index.save()
+        voltage, mpv, error, names = index.curve(paths)
+
+    Without a path the index is only kept in memory.
+    """
+
+    def __init__(self, path=None, pattern=VOLTAGE_PATTERN):
+        self.path = os.path.normpath(path) if path else None
+        self.pattern = re.compile(pattern or VOLTAGE_PATTERN)
+        self.log = logging.getLogger()
+        self.runs = {}
+        if self.path:
+            try:
+                with open(self.path) as index:
+                    self.runs = json.load(index)
+            except (OSError, ValueError):
+                if os.path.exists(self.path):
+                    self.log.warning("Could not read the run index {!s}, all runs are analysed".format(self.path))
+
+    @staticmethod
+    def stamp(path):
+        """Size and mtime of a file"""
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def outdated(self, paths, settings):
+        """Returns the runs of paths which have no valid entry in the index"""
+        outdated = []
+        for path in paths:
+            entry = self.runs.get(os.path.abspath(path))
+            if not entry or entry["stamp"] != self.stamp(path) or entry["settings"] != settings:
+                outdated.append(path)
+        return outdated
+
+    def metadata(self, path, header=""):
+        """Name of the run and the bias voltage, from the file name or else from the header"""
+        name = os.path.splitext(os.path.basename(path))[0]
+        voltage = None
+        for text in (name, header or ""):
+            found = self.pattern.findall(text)
+            if found:
+                voltage = float(found[-1])
+                break
+        return {"name": name, "voltage": voltage}
+
+    def update(self, path, settings, header="", **results):
+        """Enters the results of a run (json serializable values)
+
+        :param path: path of the run
+        :param settings: settings of the analysis (see series_settings)
+        :param header: header of the run, searched for metadata missing in the file name
+        :param results: e.g. mpv, mpv_error
+        """
+        entry = {"stamp": self.stamp(path), "settings": settings}
+        entry.update(self.metadata(path, header))
+        entry.update(results)
+        self.runs[os.path.abspath(path)] = entry
+
+    def save(self):
+        """Writes the index, first under a temporary name so it is never left broken"""
+        if not self.path:
+            return
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as index:
+            json.dump(self.runs, index, indent=1)
+        os.replace(temp_path, self.path)
+
+    def curve(self, paths=None):
+        """MPV of the runs against the bias voltage, sorted by its magnitude. Runs without a
+        voltage (nan) come last in the order of the runs.
+
+        :param paths: runs of the curve, default all runs in the index
+        :return: voltages, mpv, mpv errors, names (numpy arrays)
+        """
+        entries = list(self.runs.values()) if paths is None else \
+            [self.runs[os.path.abspath(path)] for path in paths if os.path.abspath(path) in self.runs]
+        voltage = np.array([entry["voltage"] if entry["voltage"] is not None else np.nan for entry in entries])
+        order = np.argsort(np.abs(voltage), kind="stable")
+        mpv = np.array([entry.get("mpv", np.nan) for entry in entries], dtype=np.float64)
+        error = np.array([entry.get("mpv_error", np.nan) for entry in entries], dtype=np.float64)
+        names = np.array([entry["name"] for entry in entries])
+        return voltage[order], mpv[order], error[order], names[order]
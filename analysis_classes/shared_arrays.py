@@ -0,0 +1,101 @@
+"""This file contains a container for numpy arrays which are shared with
+worker processes without copying them"""
+# pylint: disable=C0103
+
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# Space which is left free in the folder of the shared arrays
+RESERVE = 1 << 28
+
+
+def shared_folder(nbytes):
+    """/dev/shm if it has room for nbytes, otherwise the temp folder. A memory mapped file
+    on a full tmpfs (e.g. the small /dev/shm of containers) kills the process with SIGBUS
+    when a page is written, instead of raising an error, so the space is checked first.
+
+    :param nbytes: size of all arrays which will be shared
+    :return: folder, None for the default temp folder
+    """
+    log = logging.getLogger()
+    if os.path.isdir("/dev/shm"):
+        if shutil.disk_usage("/dev/shm").free >= nbytes + RESERVE:
+            return "/dev/shm"
+        log.warning("Not enough free space in /dev/shm for {:.0f} MB of shared arrays, "
+                    "using the temp folder".format(nbytes / 2 ** 20))
+    if shutil.disk_usage(tempfile.gettempdir()).free < nbytes + RESERVE:
+        raise OSError("Not enough free space for {:.0f} MB of shared arrays in /dev/shm or {!s}".format(
+            nbytes / 2 ** 20, tempfile.gettempdir()))
+    return None
+
+
+class SharedArrays:
+    """Numpy arrays stored in memory mapped files, which can be handed to the
+    workers of a process pool. Pickling only transfers the directory and the
+    array names, the workers map the same memory. On linux the files are put
+    into /dev/shm, so they never touch the disk, as long as it has room for
+    nbytes (see shared_folder).
+
+    Use it as context manager, the files are removed on exit:
+
+        with SharedArrays(events.nbytes) as shared:
+            shared.share("events", events)
+            pool.starmap(function, [(shared, start, end), ...])
+    """
+
+    def __init__(self, nbytes=0):
+        """
+        :param nbytes: size of all arrays which will be shared
+        """
+        self.directory = tempfile.mkdtemp(prefix="alibava_", dir=shared_folder(nbytes))
+        self.names = []
+        self.arrays = {}
+
+    def __getstate__(self):
+        return {"directory": self.directory, "names": self.names}
+
+    def __setstate__(self, state):
+        self.directory = state["directory"]
+        self.names = state["names"]
+        self.arrays = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getitem__(self, name):
+        if name not in self.arrays:
+            self.arrays[name] = np.load(self.path(name), mmap_mode="r+")
+        return self.arrays[name]
+
+    def path(self, name):
+        """Path of the file of an array"""
+        return os.path.join(self.directory, name + ".npy")
+
+    def create(self, name, shape, dtype=np.float32):
+        """Creates a new (zero filled) shared array"""
+        self.arrays[name] = np.lib.format.open_memmap(self.path(name), mode="w+", dtype=dtype, shape=shape)
+        self.names.append(name)
+        return self.arrays[name]
+
+    def share(self, name, array, indices=None):
+        """Copies an array (or the rows indices of it) into a new shared array"""
+        array = np.asarray(array)
+        shape = array.shape if indices is None else (len(indices),) + array.shape[1:]
+        shared = self.create(name, shape, array.dtype)
+        if indices is None:
+            shared[:] = array
+        else:
+            np.take(array, indices, axis=0, out=shared)
+        return shared
+
+    def close(self):
+        """Removes the files. Arrays still in use stay valid on linux"""
+        self.arrays = {}
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -7,34 +7,34 @@ import logging
 import os
 import struct
 import sys
-from importlib import import_module
 from warnings import warn
 
 # COMMENT: tqdm and h5py are both missing in requirements
-import h5py
-import yaml
-from matplotlib.backends.backend_pdf import PdfPages
+# h5py, yaml and matplotlib are imported where they are needed, importing them takes seconds
+import numpy as np
 from six.moves import cPickle as pickle  # for performance
+from tqdm import tqdm
 
-from analysis_classes.BaseAnalysis import *
+from analysis_classes.plugin_registry import PluginRegistry
 
 log = logging.getLogger()
 
 
-def load_plugins():
-    # Load all measurement functions
-    # install_directory = os.getcwd() # Obtain the install path of this module
-    all_plugins = {}
-    all_measurement_functions = os.listdir("./analysis_classes/")
-    all_measurement_functions = list(set([modules.split(".")[0] for modules in all_measurement_functions]))
+def load_plugins(names=None):
+    """Imports the additional analysis with the passed names (default all)
 
-    for modules in all_measurement_functions:  # import all modules from all files in the plugins folder
-        all_plugins.update({modules: import_module("analysis_classes." + modules)})
-    return all_plugins
+    :param names: names of the plugins, e.g. the additional_analysis of the config
+    :return: dict of the plugin classes
+    """
+    registry = PluginRegistry()
+    if names is None:
+        names = registry.names()
+    return {name: registry.load(name) for name in names}
 
 
 def create_dictionary(file, filepath):
     '''Creates a dictionary with all values written in the file using yaml'''
+    import yaml
 
     file_string = os.path.abspath(os.getcwd() + str(filepath) + "\\" + str(file))
     log.info("Loading file: " + str(file))
@@ -49,9 +49,10 @@ def import_h5(*pathes):
     :param pathes: pathes to the datafiles which should be imported
     :return: list
     """
+    import h5py
 
     # Check if a list was passed
-    if isinstance(pathes[0]) == list:
+    if isinstance(pathes[0], list):
         pathes = pathes[0]
 
     # First check if pathes exist and if so import
@@ -79,102 +80,340 @@ def get_xy_data(data, header=0):
             np2Darray[i-header] = np.array(list_data)
     return np2Darray
 
-def read_binary_Alibava(filepath):
-    """Reads binary alibava files"""
-
-    with open(os.path.normpath(filepath), "rb") as f:
-        header = f.read(16)
-        Starttime = struct.unpack("II", header[0:8])[0]  # Is a uint32
-        Runtype = struct.unpack("i", header[8:12])[0]  # int32
-        Headerlength = struct.unpack("I", header[12:16])
-        header = f.read(Headerlength[0])
-        Header = struct.unpack("{}s".format(Headerlength[0]), header)[0].decode("Utf-8")
-        Pedestal = np.array(struct.unpack("d" * 256, f.read(8 * 256)), dtype=np.float32)
-        Noise = np.array(struct.unpack("d" * 256, f.read(8 * 256)), dtype=np.float32)
-        byteorder = sys.byteorder
-
-        # Data Blocks
-        # Read all data Blocks
-        # Warning Alibava Binary calibration files have no indicatior how many events are really inside the file
-        # The eventnumber corresponds to the pulse number -->
-        # Readout of files have to be done until end of file is reached
-        # and the eventnumber must be calculated --> Advantage: Damaged files can be read as well
-        #events = Header.split("|")[1].split(";")[0]
-        event_data = []
-        events = 0
-        eof = False
-        #for event in range(int(events)):
-        while not eof:
-            blockheader = f.read(4)  # should be 0xcafe002
-            if blockheader == b'\x02\x00\xfe\xca' or blockheader == b'\xca\xfe\x00\x02':
-                events += 1
-                blocksize = struct.unpack("I", f.read(4))
-                event_data.append(f.read(blocksize[0]))
-            else:
-                log.info("Warning: While reading data Block {}. "
-                      "Header was not the 0xcafe0002 it was {!s}".format(events, str(blockheader)))
-                if not blockheader:
-                    log.info("Persumably end of binary file reached. Events read: {}".format(events))
-                    eof = True
-
-        dict = {"header": {
-                            "noise": Noise,
-                            "pedestal": Pedestal,
+# Markers of a data block, 0xcafe0002 in little and in big endian byte order
+ALIBAVA_BLOCK_MARKERS = np.array([0xcafe0002, 0x0200feca], dtype=np.uint32)
+
+# Layout of the payload of a 0xcafe0002 data block. Between and after the two
+# 128 channel halves the chips write header and garbage words, which are
+# skipped by the offsets
+ALIBAVA_EVENT_DTYPE = np.dtype({"names": ["clock", "coded_time", "temperature", "signal1", "signal2"],
+                                "formats": ["<u4", "<u4", "<u2", ("<i2", 128), ("<i2", 128)],
+                                "offsets": [8, 12, 16, 50, 338]})
+
+
+def parse_binary_header(buffer):
+    """Parses the file header, pedestal and noise of a binary alibava file.
+
+    :param buffer: bytes like object (or uint8 array) containing the file
+    :return: starttime, header string, pedestal, noise, offset of first data block
+    """
+    Starttime = struct.unpack("II", bytes(buffer[0:8]))[0]  # Is a uint32
+    # Runtype = struct.unpack("i", bytes(buffer[8:12]))[0]  # int32
+    Headerlength = struct.unpack("I", bytes(buffer[12:16]))[0]
+    Header = bytes(buffer[16:16 + Headerlength]).decode("Utf-8")
+    pos = 16 + Headerlength
+    Pedestal = np.frombuffer(buffer, dtype="<f8", count=256, offset=pos).astype(np.float32)
+    Noise = np.frombuffer(buffer, dtype="<f8", count=256, offset=pos + 8 * 256).astype(np.float32)
+    return Starttime, Header, Pedestal, Noise, pos + 16 * 256
+
+
+def scan_binary_blocks(buffer, start):
+    """Finds the offsets of the payloads of all data blocks.
+
+    Normally all blocks of a file have the same size, so the block headers are
+    checked at a fixed stride all at once. Only if a header is not the
+    0xcafe0002 marker or its block size is too small for an event, the scan
+    falls back to search the next valid block in 4 byte steps (damaged files
+    can be read as well).
+
+    :param buffer: bytes like object (or uint8 array) containing the file
+    :param start: offset of the first block header
+    :return: int64 array with the offsets of the block payloads
+    """
+    length = len(buffer)
+    offsets = []
+    pos = start
+    while pos + 8 <= length:
+        marker, blocksize = np.frombuffer(buffer, dtype="<u4", count=2, offset=pos)
+        if marker not in ALIBAVA_BLOCK_MARKERS:
+            log.info("Warning: While reading data Block {}. "
+                     "Header was not the 0xcafe0002 it was {!s}".format(sum(map(len, offsets)),
+                                                                       bytes(buffer[pos:pos + 4])))
+            pos += 4
+            continue
+        if blocksize < ALIBAVA_EVENT_DTYPE.itemsize:
+            # A damaged header, resync like for a wrong marker instead of dropping the rest
+            log.warning("While reading data Block {}. The block size {} is smaller than an "
+                        "event, searching the next block".format(sum(map(len, offsets)), int(blocksize)))
+            pos += 4
+            continue
+        stride = 8 + int(blocksize)
+        nblocks = (length - pos) // stride
+        if not nblocks:
+            log.info("Incomplete data block at the end of the binary file skipped")
+            break
+        headers = np.ndarray((nblocks, 2), dtype="<u4", buffer=buffer, offset=pos, strides=(stride, 4))
+        good = np.isin(headers[:, 0], ALIBAVA_BLOCK_MARKERS) & (headers[:, 1] == blocksize)
+        nvalid = nblocks if good.all() else int(np.argmin(good))
+        offsets.append(pos + 8 + stride * np.arange(nvalid, dtype=np.int64))
+        pos += stride * nvalid
+    log.info("Persumably end of binary file reached. Events read: {}".format(sum(map(len, offsets))))
+    if not offsets:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(offsets)
+
+
+def decode_binary_events(buffer, offsets, fields=("signal", "temperature", "time", "clock")):
+    """Decodes the data blocks at the passed payload offsets.
+
+    :param buffer: bytes like object (or uint8 array) containing the file
+    :param offsets: offsets of the block payloads
+    :param fields: the event quantities which should be decoded
+    :return: dict with signal, temperature, time and clock arrays
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    strides = np.diff(offsets)
+    if len(offsets) and np.all(strides == (strides[0] if len(strides) else 0)):
+        # Equidistant blocks, the records can be viewed with a stride
+        stride = int(strides[0]) if len(strides) else ALIBAVA_EVENT_DTYPE.itemsize
+        records = np.ndarray((len(offsets),), dtype=ALIBAVA_EVENT_DTYPE, buffer=buffer,
+                             offset=int(offsets[0]), strides=(stride,))
+    else:
+        raw = np.frombuffer(buffer, dtype=np.uint8)
+        records = raw[offsets[:, None] + np.arange(ALIBAVA_EVENT_DTYPE.itemsize)]
+        records = records.view(ALIBAVA_EVENT_DTYPE).reshape(len(offsets))
+
+    decoded = {}
+    if "signal" in fields:
+        signal = np.empty((len(offsets), 256), dtype=np.float32)
+        signal[:, :128] = records["signal1"]
+        signal[:, 128:] = records["signal2"]
+        decoded["signal"] = signal
+    if "temperature" in fields:
+        decoded["temperature"] = (0.12 * records["temperature"] - 39.8).astype(np.float32)
+    if "time" in fields:
+        coded_time = records["coded_time"]
+        ipart = (coded_time & 0xFFFF0000) >> 16
+        fpart = np.sign(ipart) * (coded_time & 0xFFFF)
+        decoded["time"] = (100 * ipart + fpart).astype(np.float32)
+    if "clock" in fields:
+        decoded["clock"] = records["clock"].astype(np.float32)
+    return decoded
+
+
+def read_binary_Alibava(filepath, lazy=False):
+    """Reads binary alibava files
+
+    :param filepath: path to the binary file
+    :param lazy: if True, the file is memory mapped and events are only decoded
+                 when they are accessed (see AlibavaBinaryFile)
+    """
+    if lazy:
+        return AlibavaBinaryFile(filepath).as_dict()
+
+    buffer = np.fromfile(os.path.normpath(filepath), dtype=np.uint8)
+    Starttime, Header, Pedestal, Noise, data_start = parse_binary_header(buffer)
+
+    # Data Blocks
+    # Warning Alibava Binary calibration files have no indicatior how many events are really inside the file
+    # The eventnumber corresponds to the pulse number -->
+    # Readout of files have to be done until end of file is reached
+    # and the eventnumber must be calculated --> Advantage: Damaged files can be read as well
+    offsets = scan_binary_blocks(buffer, data_start)
+    events = decode_binary_events(buffer, offsets)
+
+    dict = {"header": {
+                        "noise": Noise,
+                        "pedestal": Pedestal,
+                        "Attribute:setup": None
+                        },
+            "events": {
+                        "header": Header,
+                        "signal": events["signal"],
+                        "temperature": events["temperature"],
+                        "time": events["time"],
+                        "clock": events["clock"]
+                        },
+            "scan": {
+                    "start": Starttime,
+                    "end": None,
+                    "value": binary_scan_values(Header), # Values of cal files for example. eg. 32 pulses for
+                                                         # a charge scan steps should be here
+                    "attribute:scan_definition": None
+                    }
+            }
+    return dict
+
+
+def binary_scan_values(Header):
+    """Disects the header of a binary file for the scan values (aka xdata)"""
+    points = Header.split("|")[1].split(";")
+    params = [x.strip("\x00") for x in points]
+
+    # Alibava binary have (unfortunately) a non consistend header format
+    # Therefore, we have to distinguish between the two formats --> len(params) = 4 --> Calibration
+    # len(params) = 2 --> Eventfile
+    if len(params) >= 4: # Cal file
+        return np.arange(int(params[1]), int(params[2]), int(params[3]))
+    elif len(params) == 2: # Events file
+        return np.arange(0, int(params[0]), step=1)
+    return None
+
+class BinaryEventDataset:
+    """Gives access to one event quantity of a memory mapped binary file, the
+    same way a h5py dataset does. Only the requested events are decoded, so
+    dataset[15] or dataset[100:200] never touch the rest of the file."""
+
+    def __init__(self, binary_file, field):
+        self.file = binary_file
+        self.field = field
+        self.dtype = np.dtype(np.float32)
+        self.shape = (len(binary_file), 256) if field == "signal" else (len(binary_file),)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self.file.read(key, fields=(self.field,))[self.field]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def __repr__(self):
+        return "<Alibava binary dataset {!s}: shape {!s}, type {!s}>".format(self.field, self.shape, self.dtype)
+
+
+class AlibavaBinaryFile:
+    """Memory mapped random access to the events of a binary alibava file.
+
+    The payload offsets of all 0xcafe0002 blocks are scanned once and stored
+    next to the file (<file>.idx.npz). As long as size and modification time of
+    the file do not change, the index is loaded from there in later runs.
+    Afterwards, event N or a slice of events can be read without touching the
+    rest of the file."""
+
+    def __init__(self, filepath, use_index=True):
+        """
+        :param filepath: path to the binary file
+        :param use_index: if True, a persisted index is used and written
+        """
+        self.path = os.path.normpath(filepath)
+        self.buffer = np.memmap(self.path, dtype=np.uint8, mode="r")
+        (self.starttime, self.header, self.pedestal,
+         self.noise, data_start) = parse_binary_header(self.buffer)
+        self.index_path = self.path + ".idx.npz"
+
+        self.offsets = self.load_index() if use_index else None
+        if self.offsets is None:
+            self.offsets = scan_binary_blocks(self.buffer, data_start)
+            if use_index:
+                self.save_index()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def file_stamp(self):
+        """Size and modification time of the file, used to validate the index"""
+        stat = os.stat(self.path)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    def load_index(self):
+        """Loads the persisted block index, None if not existing or outdated"""
+        try:
+            with np.load(self.index_path) as index:
+                if np.array_equal(index["stamp"], self.file_stamp()):
+                    return index["offsets"]
+        except (OSError, KeyError, ValueError):
+            pass
+        return None
+
+    def save_index(self):
+        """Stores the block index next to the binary file"""
+        try:
+            with open(self.index_path, "wb") as f:
+                np.savez(f, offsets=self.offsets, stamp=self.file_stamp())
+        except OSError as err:
+            log.info("Could not store the event index {!s}: {!s}".format(self.index_path, err))
+
+    def read(self, key, fields=("signal", "temperature", "time", "clock")):
+        """Decodes the events selected by key (int, slice or index array)
+
+        :return: dict with the decoded quantities
+        """
+        offsets = self.offsets[key]
+        if np.ndim(offsets) == 0:
+            return {name: value[0] for name, value in
+                    decode_binary_events(self.buffer, [offsets], fields).items()}
+        return decode_binary_events(self.buffer, offsets, fields)
+
+    def as_dict(self):
+        """Returns the same layout as read_binary_Alibava, with lazy datasets"""
+        return {"header": {
+                            "noise": self.noise,
+                            "pedestal": self.pedestal,
                             "Attribute:setup": None
                             },
                 "events": {
-                            "header": Header,
-                            "signal": np.zeros((int(events),256), dtype=np.float32),
-                            "temperature": np.zeros(int(events), dtype=np.float32),
-                            "time": np.zeros(int(events), dtype=np.float32),
-                            "clock": np.zeros(int(events), dtype=np.float32)
+                            "header": self.header,
+                            "signal": BinaryEventDataset(self, "signal"),
+                            "temperature": BinaryEventDataset(self, "temperature"),
+                            "time": BinaryEventDataset(self, "time"),
+                            "clock": BinaryEventDataset(self, "clock")
                             },
                 "scan": {
-                        "start": Starttime,
+                        "start": self.starttime,
                         "end": None,
-                        "value": None, # Values of cal files for example. eg. 32 pulses for
-                                       # a charge scan steps should be here
+                        "value": binary_scan_values(self.header),
                         "attribute:scan_definition": None
                         }
                 }
 
-        # Disect the header for the correct informations for values
-        points = Header.split("|")[1].split(";")
-        params = [x.strip("\x00") for x in points]
-
-        # Alibava binary have (unfortunately) a non consistend header format
-        # Therefore, we have to distinguish between the two formats --> len(params) = 4 --> Calibration
-        # len(params) = 2 --> Eventfile
-
-        if len(params) >= 4: # Cal file
-            dict["scan"]["value"] = np.arange(int(params[1]), int(params[2]), int(params[3]))  # aka xdata
-        elif len(params) == 2: # Events file
-            dict["scan"]["value"] = np.arange(0, int(params[0]),step=1)  # aka xdata
-
-        shift1 = int.from_bytes(b'0xFFFF0000',byteorder=byteorder)
-        shift2 = int.from_bytes(b'0xFFFF',byteorder=byteorder)
-        # decode data from data Blocks
-        for i, event in enumerate(event_data):
-            dict["events"]["clock"][i] = struct.unpack("III", event[0:12])[-1]
-            coded_time = struct.unpack("I", event[12:16])[0]
-            #coded_time = event[12:16]
-            ipart = (coded_time & shift1)>>16
-            fpart = (np.sign(ipart))*(coded_time & shift2)
-            time = 100*ipart+fpart
-            dict["events"]["time"][i] = time
-            dict["events"]["temperature"][i] = 0.12*struct.unpack("H", event[16:18])[0]-39.8
-
-            # There seems to be garbage data which needs to be cut out
-            padding = 18+32
-            part1 = list(struct.unpack("h"*128, event[padding:padding+2*128]))
-            padding += 2*130+28
-            part2 = list(struct.unpack("h" * 128, event[padding:padding + 2*128]))
-            part1.extend(part2)
-            dict["events"]["signal"][i] = np.array(part1)
-            #dict["events"]["signal"][i] =struct.unpack("H"*256, event[18:18+2*256])
-            #extra = struct.unpack("d", event[18+2*256:18+2*256+4])[0]
 
-    return dict
+def iter_event_chunks(events, chunk_size):
+    """Iterates over the events of a file in chunks of chunk_size events. Only
+    the current chunk is read into memory, this works for h5py datasets, lazy
+    binary datasets and numpy arrays alike.
+
+    :param events: the "events" group of a loaded file
+    :param chunk_size: number of events per chunk
+    :return: generator of (index of first event, signal, time) of every chunk
+    """
+    numevents = len(events["signal"])
+    for start in range(0, numevents, chunk_size):
+        stop = min(start + chunk_size, numevents)
+        yield (start,
+               np.array(events["signal"][start:stop], dtype=np.float32),
+               np.array(events["time"][start:stop], dtype=np.float32))
+
+
+class RunningStats:
+    """Running mean and variance per column, updated with chunks of rows.
+    Chunks (or other RunningStats) are merged with the parallel variant of
+    Welford's algorithm (Chan et al.), so the result does not depend on the
+    chunk size and stays numerically stable for long runs."""
+
+    def __init__(self, size):
+        self.count = 0
+        self.mean = np.zeros(size, dtype=np.float64)
+        self.M2 = np.zeros(size, dtype=np.float64)
+
+    def add(self, values):
+        """Adds the rows of a (rows, size) array"""
+        values = np.asarray(values, dtype=np.float64)
+        if len(values):
+            mean = np.mean(values, axis=0)
+            self._merge(len(values), mean, np.sum((values - mean) ** 2, axis=0))
+
+    def merge(self, other):
+        """Merges another RunningStats into this one"""
+        if other.count:
+            self._merge(other.count, other.mean, other.M2)
+
+    def _merge(self, count, mean, M2):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * count / total
+        self.M2 = self.M2 + M2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+    def var(self):
+        """Population variance, like np.var"""
+        return self.M2 / max(self.count, 1)
+
+    def std(self):
+        """Population standard deviation, like np.std"""
+        return np.sqrt(self.var())
+
 
 def read_file(filepath, binary=False):
     """Just reads a file and returns the content line by line"""
@@ -225,6 +464,8 @@ def save_all_plots(name, folder, figs=None, dpi=200):
     :return: None
     """
     # COMMENT: dpi unused???'
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
     try:
         pp = PdfPages(os.path.normpath(folder) + "\\" + name + ".pdf")
     except PermissionError:
@@ -261,34 +502,24 @@ def gaussian(x, mu, sig, a):
     """Doc of function"""
     return a*np.exp(-np.power(x - mu, 2.) / (2. * np.power(sig, 2.)))
 
-def langau_cluster(cls_ind, valid_events_Signal, valid_events_clusters,
-                   charge_cal, noise):
-    """Calculates the energy of events, clustersize independend"""
-    # for size in tqdm(clustersize_list, desc="(langau) Processing clustersize"):
-    totalE = np.zeros(len(cls_ind))
-    totalNoise = np.zeros(len(cls_ind))
-    # Loop over the clustersize to get total deposited energy
-    incrementor = 0
-    for ind in tqdm(cls_ind, desc="(langau) Processing event"):
-        # TODO: make this work for multiple cluster in one event
-        # Signal calculations
-        signal_clst_event = np.take(valid_events_Signal[ind],
-                                    valid_events_clusters[ind][0])
-        totalE[incrementor] = np.sum(convert_ADC_to_e(signal_clst_event,
-                                                      charge_cal))
-
-        # Noise Calculations
-
-        # Get the Noise of an event
-        noise_clst_event = np.take(noise, valid_events_clusters[ind][0])
-        # eError is a list containing electron signal noise
-        totalNoise[incrementor] = np.sqrt(np.sum(\
-                convert_ADC_to_e(noise_clst_event, charge_cal)))
-
-        incrementor += 1
-
-    preresults = {"signal": totalE, "noise": totalNoise}
-    return preresults
+def cluster_energies(store, charge_cal, noise):
+    """Calculates the energy and the noise in electrons of all clusters of an EventStore
+    at once. Clusters of every size are considered and every cluster of events with
+    multiple clusters.
+
+    :param store: EventStore which kept the signal of the events
+    :param charge_cal: function converting ADC to electrons
+    :param noise: noise of the strips in ADC
+    :return: dict with the signal and noise of every cluster (ordered like store.cluster_event)
+    """
+    if not len(store.cluster_size):
+        return {"signal": np.zeros(0), "noise": np.zeros(0)}
+    starts = store.cluster_offsets[:-1]
+    totalE = np.add.reduceat(convert_ADC_to_e(store.cluster_signal(), charge_cal), starts)
+    # eError is a list containing electron signal noise
+    totalNoise = np.sqrt(np.add.reduceat(convert_ADC_to_e(np.take(noise, store.cluster_members),
+                                                          charge_cal), starts))
+    return {"signal": totalE, "noise": totalNoise}
 
 def get_size(obj, seen=None):
     """Recursively finds size of objects"""
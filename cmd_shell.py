@@ -97,12 +97,14 @@ class AlisysShell(cmd.Cmd):
             configs = create_dictionary(os.path.normpath(config_file), "")
             # Todo: In new version this will not work anymore
             self.results_obj = do_with_config_file(configs)
+            import matplotlib.pyplot as plt
             plt.show()
         else:
             print("Please enter a valid filepath!")
 
     def do_plotEvent(self):
         """This function plots a Single event of all processed files"""
+        import matplotlib.pyplot as plt
         plt.show()  # todo: write the cmd plot functions
         pass
 
@@ -3,9 +3,8 @@
 
 from optparse import OptionParser
 
-from analysis_classes.Calibration import Calibration
-from analysis_classes.NoiseAnalysis import NoiseAnalysis
-from analysis_classes.main_loops import MainLoops
+from analysis_classes.kernel_cache import set_cache_dir, precompile
+from analysis_classes.result_cache import ResultCache
 from analysis_classes.utilities import *
 from cmd_shell import AlisysShell
 
@@ -20,16 +19,29 @@ if log.hasHandlers() is False:
 
 def do_with_config_file(config):
     """Starts analysis with a config file"""
+    # The compiled Numba kernels are cached in this folder (shared by all processes) if specified
+    if config.get("Numba_cache_folder", ""):
+        set_cache_dir(config["Numba_cache_folder"])
+
+    # The analysis imports matplotlib, scipy and numba, which is not needed e.g. for the shell
+    from analysis_classes.calibration import Calibration
+    from analysis_classes.NoiseAnalysis import NoiseAnalysis
+    from analysis_classes.main_loops import MainLoops
+
+    # Pedestal and calibration results are cached in this folder if specified
+    cache = ResultCache(config["Cache_folder"]) if config.get("Cache_folder", "") else None
 
     # Look if a pedestal file is specified
     if "Pedestal_file" in config:
-        noise_data = NoiseAnalysis(config["Pedestal_file"], usejit=config.get("optimize", False), configs=config)
+        noise_data = NoiseAnalysis(config["Pedestal_file"], usejit=config.get("optimize", False), configs=config,
+                                   cache=cache)
         noise_data.plot_data()
 
     # Look if a calibration file is specified
     if "Delay_scan" in config or "Charge_scan" in config:
         config_data = Calibration(config.get("Delay_scan", ""), config.get("Charge_scan", ""), Noise_calc=noise_data,
-                                  isBinary=config.get("isBinary", False))
+                                  isBinary=config.get("isBinary", False),
+                                  lut_step=config.get("calibration_lut_step", 0.), cache=cache)
         config_data.plot_data()
 
     # Look if a pedestal file is specified
@@ -51,7 +63,10 @@ def do_with_config_file(config):
 def main(args, options):
     """The main analysis which will be executed after the arguments are parsed"""
 
-    if options.shell:
+    if options.precompile:
+        precompile(options.precompile)
+
+    elif options.shell:
         shell = AlisysShell()
         # shell.start_shell()
 
@@ -59,6 +74,7 @@ def main(args, options):
     elif options.configfile and os.path.exists(os.path.normpath(options.configfile)):
         configs = create_dictionary(os.path.normpath(options.configfile), "")
         do_with_config_file(configs)
+        import matplotlib.pyplot as plt
         plt.show()  # Just in case the plot show has never been shown
 
     elif options.filepath and os.path.exists(os.path.normpath(options.filepath)):
@@ -89,6 +105,12 @@ if __name__ == "__main__":
                       help="Runs the shell interface for the anlysis",
                       )
 
+    parser.add_option("--precompile",
+                      dest="precompile", action="store", type="string",
+                      help="Compiles the Numba kernels into this cache folder and reports the compile times",
+                      default=""
+                      )
+
     (options, args) = parser.parse_args()
 
     # Run the main routines